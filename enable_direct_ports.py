@@ -2,13 +2,16 @@
 """
 Скрипт для включения прямого доступа через порты (fallback при проблемах с SSL)
 """
-import re
 from pathlib import Path
 from rich.console import Console
 from rich.panel import Panel
 from dotenv import load_dotenv
 import os
 
+from installer.compose_patterns import (
+    COMMENTED_PORTS_RE, DEPLOY_RE, ENABLED_PORTS_RE, service_blocks
+)
+
 console = Console()
 
 
@@ -47,76 +50,34 @@ def enable_ports_for_service(content, service_name, port_env_var, default_port):
     # Определяем внутренний порт (обычно такой же как внешний для этих сервисов)
     internal_port = default_port
     
+    # Ищем блок сервиса и работаем только внутри него
+    block = service_blocks(content).get(service_name)
+    if block is None:
+        console.print(f"[yellow]⚠ Не удалось автоматически включить порт для {service_name}[/yellow]")
+        return content
+    start, end = block
+    
     # Проверяем, есть ли уже незакомментированная секция ports
-    if re.search(rf'^\s+{service_name}:[^\n]*\n(?:[^\n]*\n)*?\s+ports:\s*$', content, re.MULTILINE):
+    if ENABLED_PORTS_RE.search(content, start, end):
         console.print(f"[cyan]ℹ Секция ports уже существует для {service_name}, пропускаем[/cyan]")
         return content
     
-    # Паттерн 1: стандартный формат с комментарием "ВАЖНО: Не открываем порт..."
-    pattern1 = rf'(\s+{service_name}:[^\n]*\n(?:(?!\s+[a-z-]+:)[^\n]*\n)*?)(\s+)# ВАЖНО: Не открываем порт наружу напрямую! Прокси через Caddy\.\n(\s+)# ports:\n(\s+)#\s+- "[^"]+":(\d+)'
-    
-    def replace_commented_ports1(match):
-        before_comment = match.group(1)
-        indent = match.group(2)
-        indent2 = match.group(3)
-        indent3 = match.group(4)
-        internal_port_found = match.group(5)
-        
-        # Используем найденный внутренний порт или дефолтный
-        internal = internal_port_found if internal_port_found else internal_port
-        
-        ports_section = f'{indent}# Прямой доступ через порт (fallback при проблемах с SSL)\n{indent2}ports:\n{indent3}  - "{port}:{internal}"\n'
-        
-        return f'{before_comment}{ports_section}'
-    
-    new_content = re.sub(pattern1, replace_commented_ports1, content, flags=re.MULTILINE)
-    
-    if new_content != content:
-        console.print(f"[green]✓ Порт {port} включен для {service_name}[/green]")
-        return new_content
-    
-    # Паттерн 2: любой закомментированный блок ports
-    pattern2 = rf'(\s+{service_name}:[^\n]*\n(?:(?!\s+[a-z-]+:)[^\n]*\n)*?)(\s+)#.*[пп]орт.*\n(\s+)#\s+ports:\n(\s+)#\s+- "[^"]+":(\d+)'
-    
-    def replace_commented_ports2(match):
-        before_comment = match.group(1)
-        indent = match.group(2)
-        indent2 = match.group(3)
-        indent3 = match.group(4)
-        internal_port_found = match.group(5)
-        
-        internal = internal_port_found if internal_port_found else internal_port
-        
+    # Закомментированный блок ports (в т.ч. "ВАЖНО: Не открываем порт...")
+    match = COMMENTED_PORTS_RE.search(content, start, end)
+    if match:
+        indent, indent2, indent3, internal = match.groups()
         ports_section = f'{indent}# Прямой доступ через порт (fallback при проблемах с SSL)\n{indent2}ports:\n{indent3}  - "{port}:{internal}"\n'
-        
-        return f'{before_comment}{ports_section}'
-    
-    new_content = re.sub(pattern2, replace_commented_ports2, content, flags=re.MULTILINE)
-    
-    if new_content != content:
-        console.print(f"[green]✓ Порт {port} включен для {service_name}[/green]")
-        return new_content
-    
-    # Паттерн 3: вставляем перед deploy (если закомментированных портов нет)
-    pattern3 = rf'(\s+{service_name}:[^\n]*\n(?:(?!\s+deploy:)[^\n]*\n)*?)(\s+)(deploy:)'
-    
-    def insert_before_deploy(match):
-        before_deploy = match.group(1)
-        indent = match.group(2)
-        deploy_section = match.group(3)
-        
-        ports_section = f'{indent}# Прямой доступ через порт (fallback при проблемах с SSL)\n{indent}ports:\n{indent}  - "{port}:{internal_port}"\n'
-        
-        return f'{before_deploy}{ports_section}{indent}{deploy_section}'
-    
-    new_content = re.sub(pattern3, insert_before_deploy, content, flags=re.MULTILINE)
-    
-    if new_content != content:
-        console.print(f"[green]✓ Порт {port} включен для {service_name}[/green]")
-        return new_content
     else:
-        console.print(f"[yellow]⚠ Не удалось автоматически включить порт для {service_name}[/yellow]")
-        return content
+        # Закомментированных портов нет — вставляем перед deploy
+        match = DEPLOY_RE.search(content, start, end)
+        if not match:
+            console.print(f"[yellow]⚠ Не удалось автоматически включить порт для {service_name}[/yellow]")
+            return content
+        indent = match.group(1)
+        ports_section = f'{indent}# Прямой доступ через порт (fallback при проблемах с SSL)\n{indent}ports:\n{indent}  - "{port}:{internal_port}"\n{match.group(0)}'
+    
+    console.print(f"[green]✓ Порт {port} включен для {service_name}[/green]")
+    return content[:match.start()] + ports_section + content[match.end():]
 
 
 def main():
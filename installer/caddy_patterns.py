@@ -0,0 +1,50 @@
+"""
+Общие паттерны и функции для правки Caddyfile
+"""
+import re
+from typing import Optional, Tuple
+
+# Строка "email ..." в начале глобального блока (вместе с переводом строки)
+EMAIL_LINE_RE = re.compile(r'\s*email[ \t]+[^\n]*\n?')
+
+# Фигурные скобки и комментарии "# ..." (скобки в комментариях не считаются)
+_BRACE_TOKEN_RE = re.compile(r'[{}]|(?<![^\s])#[^\n]*')
+
+
+def find_global_block(text: str) -> Optional[Tuple[int, int]]:
+    """
+    Находит глобальный блок опций Caddyfile
+    
+    Глобальный блок — первая значащая строка файла "{". Закрывающая скобка
+    ищется одним проходом с подсчетом вложенности, поэтому вложенные блоки
+    и плейсхолдеры вида {CADDY_EMAIL} не обрывают блок раньше времени.
+    Возвращает (начало строки после "{", позиция закрывающей "}") или None.
+    """
+    pos = 0
+    length = len(text)
+    # Пропускаем пустые строки и комментарии перед блоком
+    while pos < length:
+        line_end = text.find('\n', pos)
+        if line_end == -1:
+            line_end = length
+        stripped = text[pos:line_end].strip()
+        if stripped and not stripped.startswith('#'):
+            break
+        pos = line_end + 1
+    else:
+        return None
+    
+    if stripped != '{':
+        return None
+    
+    start = min(line_end + 1, length)
+    depth = 1
+    for match in _BRACE_TOKEN_RE.finditer(text, start):
+        token = match.group(0)
+        if token == '{':
+            depth += 1
+        elif token == '}':
+            depth -= 1
+            if depth == 0:
+                return start, match.start()
+    return None
@@ -0,0 +1,53 @@
+"""
+Общие паттерны и функции для правки docker-compose.yml
+
+Если установлен google-re2, паттерны компилируются им (линейное время
+сопоставления), иначе используется стандартный re. Паттерны написаны
+в общем для обоих движков подмножестве: без lookahead/lookbehind,
+флаги заданы внутри паттерна.
+"""
+import re
+from typing import Dict, Tuple
+
+try:
+    import re2 as _regex
+except ImportError:
+    _regex = re
+
+# Граница блока: заголовок сервиса (отступ в два пробела) или строка верхнего уровня
+_BLOCK_BOUNDARY_RE = _regex.compile(r'(?m)^(?:  ([\w][\w.-]*):[ \t]*$|(\S[^\n]*))')
+
+# Паттерны внутри блока одного сервиса (без вложенных lookahead)
+ENABLED_PORTS_RE = _regex.compile(r'(?m)^[ \t]+ports:[ \t]*$')
+# Закомментированный блок ports с поясняющим комментарием про порт,
+# например "# ВАЖНО: Не открываем порт наружу напрямую! Прокси через Caddy."
+COMMENTED_PORTS_RE = _regex.compile(
+    r'(?m)^([ \t]+)#[^\n]*[Пп]орт[^\n]*\n([ \t]+)#[ \t]*ports:[ \t]*\n([ \t]+)#[ \t]*- "(?:[^"\n]*:)?(\d+)"[^\n]*\n?'
+)
+DEPLOY_RE = _regex.compile(r'(?m)^([ \t]+)deploy:')
+
+
+def service_blocks(content: str) -> Dict[str, Tuple[int, int]]:
+    """
+    Находит блоки сервисов секции services: — {имя: (начало, конец)}
+    
+    Один проход по заголовкам; паттерны выше затем ищутся только внутри
+    нужного блока через pattern.search(content, start, end).
+    """
+    blocks = {}
+    in_services = False
+    name = start = None
+    for match in _BLOCK_BOUNDARY_RE.finditer(content):
+        if name is not None:
+            blocks[name] = (start, match.start())
+            name = None
+        if match.group(1) is None:
+            # Комментарий верхнего уровня закрывает блок, но не секцию
+            top_level = match.group(2).rstrip()
+            if not top_level.startswith('#'):
+                in_services = top_level == 'services:'
+        elif in_services:
+            name, start = match.group(1), match.end()
+    if name is not None:
+        blocks[name] = (start, len(content))
+    return blocks
@@ -2,6 +2,7 @@
 Модуль генерации конфигурационных файлов
 """
 import os
+import re
 import subprocess
 from pathlib import Path
 from typing import Dict, Optional
@@ -10,10 +11,27 @@ from installer.utils import (
     generate_secret_key, generate_password
 )
 
+# Глобальный блок Caddyfile.template и очистка старых директив при включении staging
+_CADDY_GLOBAL_BLOCK_RE = re.compile(r'(\{\s*\n\s*email\s+\{[^}]+\}\s*\n?)(.*?)(\})', re.DOTALL)
+_CADDY_ACME_CA_RE = re.compile(r'\s+acme_ca\s+[^\n]+\n?')
+_CADDY_LETSENCRYPT_COMMENT_RE = re.compile(r'\s+# Let\'s Encrypt.*?\n', re.MULTILINE)
+_CADDY_AUTO_COMMENT_RE = re.compile(r'\s+# Caddy автоматически.*?\n', re.MULTILINE)
 
-def generate_env_file(config: Dict, output_path: str = ".env") -> None:
+# Имя переменной в строке KEY=VALUE сгенерированного .env
+_ENV_KEY_RE = re.compile(r'^([A-Za-z_][A-Za-z0-9_]*)=', re.MULTILINE)
+
+
+def generate_env_file(config: Dict, output_path: str = ".env",
+                      existing: Optional[Dict[str, str]] = None) -> None:
     """
     Генерирует .env файл из конфигурации
+    
+    Args:
+        config: Конфигурация установки
+        output_path: Путь к создаваемому файлу
+        existing: Уже разобранные переменные текущего .env. Те из них,
+            которых нет в шаблоне (добавленные вручную), дописываются в конец
+            файла, чтобы перегенерация их не теряла.
     """
     template_path = get_project_root() / "templates" / "env.template"
     
@@ -127,7 +145,6 @@ def generate_env_file(config: Dict, output_path: str = ".env") -> None:
         # Экранируем $ как $$ (Docker Compose синтаксис для экранирования)
         # Это предотвратит интерпретацию подстрок вида ${something} как переменных
         # Заменяем все $ на $$, кроме тех, которые уже экранированы ($$)
-        import re
         # Экранируем $ которые не являются частью уже экранированного $$
         # Паттерн: $ который не предшествует другому $
         value = re.sub(r'(?<!\$)\$(?!\$)', '$$', value)
@@ -147,9 +164,29 @@ def generate_env_file(config: Dict, output_path: str = ".env") -> None:
         else:
             content = content.replace(f'{{{key}}}', str(value))
     
+    if existing:
+        known_keys = set(_ENV_KEY_RE.findall(content))
+        extra_lines = [
+            f'{key}={_quote_env_value(value)}'
+            for key, value in existing.items()
+            if key not in known_keys and _ENV_KEY_RE.match(f'{key}=')
+        ]
+        if extra_lines:
+            content = content.rstrip('\n') + (
+                '\n\n# Переменные, добавленные вручную (сохранены при перегенерации)\n'
+                + '\n'.join(extra_lines) + '\n'
+            )
+    
     write_file(output_path, content)
 
 
+def _quote_env_value(value: str) -> str:
+    """Берет значение в кавычки, если в нем есть пробелы или #"""
+    if any(char in value for char in ' \t#') and '"' not in value:
+        return f'"{value}"'
+    return value
+
+
 def generate_base_env_template() -> str:
     """Генерирует базовый шаблон .env если файла нет"""
     return """# ============================================
@@ -271,7 +308,6 @@ def generate_docker_compose(config: Dict, hardware: Dict, output_path: str = "do
     if template_name == "docker-compose.cpu.template" and ollama_enabled:
         # Проверяем, есть ли уже секция ollama
         if '  ollama:' not in content:
-            import re
             # Находим место перед caddy для вставки ollama
             ollama_service = f"""  ollama:
     image: ${{OLLAMA_IMAGE:-ollama/ollama:latest}}
@@ -348,7 +384,6 @@ def generate_docker_compose(config: Dict, hardware: Dict, output_path: str = "do
         langflow_cors_origins = '*'
     
     # Заменяем CORS в шаблоне
-    import re
     content = re.sub(
         r'\$\{LANGFLOW_CORS_ORIGINS:-\*\}',
         langflow_cors_origins,
@@ -393,7 +428,6 @@ def generate_docker_compose(config: Dict, hardware: Dict, output_path: str = "do
     use_direct_ports = config.get('use_direct_ports', False) or routing_mode == 'none'
     
     if use_direct_ports:
-        import re
         # Раскомментируем порты для включенных сервисов
         if n8n_enabled:
             # Раскомментируем порты для n8n
@@ -431,7 +465,6 @@ def generate_docker_compose(config: Dict, hardware: Dict, output_path: str = "do
     # Шаблоны уже используют ${VAR} синтаксис, поэтому просто записываем как есть
     # Но нужно добавить env_file если его нет
     if 'env_file:' not in content and 'x-env-file:' not in content:
-        import re
         # Убираем устаревший version и добавляем x-env-file
         # Удаляем строку version если есть
         content = re.sub(r"^version:\s*['\"]?3\.8['\"]?\s*\n", "", content, flags=re.MULTILINE)
@@ -595,7 +628,6 @@ def generate_caddyfile(config: Dict, output_path: str = "Caddyfile") -> None:
     
     # Если хеш не сгенерирован, удаляем секцию basic_auth из Supabase Studio
     if not supabase_password_hash:
-        import re
         # Удаляем блок basic_auth для Supabase Studio
         basicauth_pattern = r'    basic_auth \{[^}]*\{SUPABASE_ADMIN_LOGIN\}[^}]*\{SUPABASE_ADMIN_PASSWORD_HASH\}[^}]*\}\n'
         content = re.sub(basicauth_pattern, '', content)
@@ -603,17 +635,15 @@ def generate_caddyfile(config: Dict, output_path: str = "Caddyfile") -> None:
     # Добавляем acme_ca для staging если выбрано
     if letsencrypt_staging:
         # Ищем глобальный блок и добавляем staging acme_ca
-        global_block_pattern = r'(\{\s*\n\s*email\s+\{[^}]+\}\s*\n?)(.*?)(\})'
-        
         def add_staging_acme(match):
             email_line = match.group(1)  # "    email {CADDY_EMAIL}\n"
             rest = match.group(2)  # остальное содержимое
             footer = match.group(3)  # "}"
             
             # Удаляем старые acme_ca если есть
-            rest = re.sub(r'\s+acme_ca\s+[^\n]+\n?', '', rest)
-            rest = re.sub(r'\s+# Let\'s Encrypt.*?\n', '', rest, flags=re.MULTILINE)
-            rest = re.sub(r'\s+# Caddy автоматически.*?\n', '', rest, flags=re.MULTILINE)
+            rest = _CADDY_ACME_CA_RE.sub('', rest)
+            rest = _CADDY_LETSENCRYPT_COMMENT_RE.sub('', rest)
+            rest = _CADDY_AUTO_COMMENT_RE.sub('', rest)
             
             # Добавляем staging
             staging_config = '    # Let\'s Encrypt Staging - для тестирования (более высокие лимиты)\n'
@@ -624,7 +654,7 @@ def generate_caddyfile(config: Dict, output_path: str = "Caddyfile") -> None:
             rest = staging_config + rest
             return f"{email_line}{rest}{footer}"
         
-        content = re.sub(global_block_pattern, add_staging_acme, content, flags=re.DOTALL)
+        content = _CADDY_GLOBAL_BLOCK_RE.sub(add_staging_acme, content)
     
     # Заменяем переменные (только для включенных сервисов)
     replacements = {
@@ -641,8 +671,6 @@ def generate_caddyfile(config: Dict, output_path: str = "Caddyfile") -> None:
     for key, value in replacements.items():
         content = content.replace(f'{{{key}}}', str(value))
     
-    import re
-    
     # Удаляем секции для невыбранных сервисов или если домен пустой
     # Важно: проверяем после замены переменных, чтобы удалить блоки с пустыми доменами
     if not n8n_enabled or not n8n_domain or n8n_domain == 'localhost':
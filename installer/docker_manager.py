@@ -4,7 +4,8 @@
 import subprocess
 import sys
 import re
-from typing import Optional, Dict, List
+import threading
+from typing import Callable, Optional, Dict, List
 from rich.console import Console
 from rich.progress import Progress, SpinnerColumn, TextColumn, BarColumn, TimeRemainingColumn, TaskID
 
@@ -245,8 +246,17 @@ def docker_compose_down(file: Optional[str] = None) -> bool:
         return False
 
 
-def docker_compose_pull(file: Optional[str] = None) -> bool:
-    """Обновляет образы"""
+def docker_compose_pull(file: Optional[str] = None,
+                        on_output: Optional[Callable[[str], None]] = None) -> bool:
+    """
+    Обновляет образы
+    
+    Args:
+        file: Путь к docker-compose.yml файлу
+        on_output: Вызывается для каждой строки вывода pull по мере загрузки
+            (например, чтобы показать текущий образ в уже открытом Progress).
+            Без него показывается собственный спиннер.
+    """
     cmd = get_docker_compose_command()
     
     if file:
@@ -255,6 +265,26 @@ def docker_compose_pull(file: Optional[str] = None) -> bool:
     cmd.append('pull')
     
     try:
+        if on_output:
+            # Docker Compose пишет прогресс в stderr, читаем его вместе с stdout
+            process = subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                bufsize=1
+            )
+            timer = threading.Timer(600, process.kill)
+            timer.start()
+            try:
+                for line in process.stdout:
+                    line = line.strip()
+                    if line:
+                        on_output(line)
+                return process.wait() == 0
+            finally:
+                timer.cancel()
+        
         with Progress(
             SpinnerColumn(),
             TextColumn("[progress.description]{task.description}"),
@@ -329,3 +359,36 @@ def get_running_services() -> List[str]:
     except Exception:
         return []
 
+
+
+def start_caddy_restart() -> Optional[subprocess.Popen]:
+    """Запускает перезапуск Caddy в фоне, не дожидаясь завершения"""
+    try:
+        return subprocess.Popen(
+            ['docker-compose', 'restart', 'caddy'],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True
+        )
+    except Exception as e:
+        console.print(f"[yellow]⚠ Не удалось перезапустить Caddy: {e}[/yellow]")
+        console.print("[cyan]💡 Запустите вручную: docker-compose restart caddy[/cyan]")
+        return None
+
+
+def wait_caddy_restart(process: subprocess.Popen, timeout: int = 30) -> bool:
+    """Дожидается перезапуска Caddy, запущенного через start_caddy_restart()"""
+    try:
+        _, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        stderr = "таймаут"
+    
+    if process.returncode == 0:
+        console.print("[green]✓ Caddy перезапущен[/green]")
+        return True
+    
+    console.print(f"[yellow]⚠ Не удалось перезапустить Caddy: {stderr.strip()}[/yellow]")
+    console.print("[cyan]💡 Запустите вручную: docker-compose restart caddy[/cyan]")
+    return False
@@ -3,9 +3,21 @@
 """
 import os
 import secrets
+import shutil
 import string
+from functools import lru_cache
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Optional
+
+
+# Значения переменных окружения, которые считаются включёнными
+_TRUTHY = frozenset({'true', '1', 'yes', 'on'})
+
+
+def _truthy(name: str, default: bool = False, env: Optional[Dict[str, str]] = None) -> bool:
+    """Читает булеву переменную из env (по умолчанию os.environ)"""
+    value = (os.environ if env is None else env).get(name)
+    return default if value is None else value.strip().lower() in _TRUTHY
 
 
 def generate_secret_key(length: int = 64) -> str:
@@ -28,9 +40,10 @@ def ensure_dir(path: str) -> Path:
     return dir_path
 
 
+@lru_cache(maxsize=None)
 def get_project_root() -> Path:
-    """Возвращает корневую директорию проекта"""
-    return Path(__file__).parent.parent
+    """Возвращает корневую директорию проекта (вычисляется один раз)"""
+    return Path(__file__).resolve().parent.parent
 
 
 def read_template(template_name: str) -> str:
@@ -48,6 +61,63 @@ def write_file(path: str, content: str) -> None:
     file_path.write_text(content, encoding='utf-8')
 
 
+def copy_mode_and_owner(src, dst) -> None:
+    """
+    Переносит права доступа и владельца файла src на файл dst
+    
+    Владельца может сменить только root; при запуске от обычного
+    пользователя переносятся только права.
+    """
+    shutil.copymode(src, dst)
+    if hasattr(os, 'geteuid') and os.geteuid() == 0:
+        st = os.stat(src)
+        os.chown(dst, st.st_uid, st.st_gid)
+
+
+def write_file_atomic(path, content: str, keep_mode: bool = False) -> None:
+    """
+    Атомарно записывает текст в файл через временный файл и os.replace
+    
+    Временный файл сразу создается с правами 0600, поэтому секреты из
+    content ни в какой момент не доступны другим пользователям, а читатель
+    видит либо старую, либо полностью записанную версию. С keep_mode=True
+    права и владелец существующего файла переносятся на новый.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        if keep_mode and path.exists():
+            copy_mode_and_owner(path, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def update_env_values(env_content: str, updates: Dict[str, str]) -> str:
+    """
+    Заменяет значения существующих переменных в тексте .env
+    
+    Один проход по строкам без регулярных выражений; строки KEY=..., которых
+    нет в updates, а также комментарии остаются без изменений.
+    Отсутствующие в файле ключи не добавляются.
+    """
+    lines = []
+    for line in env_content.splitlines(keepends=True):
+        key, sep, value = line.partition('=')
+        if sep and key in updates:
+            line_ending = value[len(value.rstrip('\r\n')):]
+            line = f"{key}={updates[key]}{line_ending}"
+        lines.append(line)
+    return ''.join(lines)
+
+
 def check_port_available(port: int) -> bool:
     """Проверяет доступен ли порт"""
     import socket
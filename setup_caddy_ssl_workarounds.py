@@ -4,40 +4,49 @@
 Основано на статьях:
 - https://habr.com/ru/articles/923150/
 - https://samjmck.com/en/blog/using-caddy-with-cloudflare/
+
+Для автоматизации все ответы можно передать флагами или YAML-пресетом:
+    python3 setup_caddy_ssl_workarounds.py --yes --email no-reply@example.com --email-count 5
+    python3 setup_caddy_ssl_workarounds.py --config preset.yaml
 """
+import argparse
 import os
 import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from rich.console import Console
 from rich.panel import Panel
 from rich.prompt import Prompt, Confirm
-from dotenv import load_dotenv
+
+from installer.utils import write_file_atomic
 
 console = Console()
 
-def setup_dns_challenge_cloudflare():
+def setup_dns_challenge_cloudflare(cloudflare_token=None, unattended=False):
     """Настройка DNS challenge через Cloudflare"""
     console.print("\n[cyan]🔧 Настройка DNS Challenge через Cloudflare[/cyan]")
     console.print("[yellow]Это позволит обойти HTTP-01 проверку и лимиты Let's Encrypt[/yellow]")
     console.print("[dim]⚠ ОПЦИОНАЛЬНО: Нужно только если используете Cloudflare DNS[/dim]")
     
-    use_cloudflare = Confirm.ask("Используете Cloudflare для ваших доменов?", default=False)
-    
-    if not use_cloudflare:
-        console.print("[cyan]ℹ Пропускаем настройку Cloudflare (не обязательно)[/cyan]")
-        return None
-    
-    console.print("\n[yellow]💡 Как получить Cloudflare API Token:[/yellow]")
-    console.print("1. Зайдите в Cloudflare Dashboard → My Profile → API Tokens")
-    console.print("2. Create Token → Permissions: Zone → DNS → Edit")
-    console.print("3. Zone Resources: Include → All zones")
-    console.print("4. Скопируйте токен\n")
-    
-    cloudflare_token = Prompt.ask(
-        "Введите Cloudflare API Token (или нажмите Enter чтобы пропустить)",
-        default="",
-        password=True
-    )
+    if cloudflare_token is None:
+        use_cloudflare = not unattended and Confirm.ask("Используете Cloudflare для ваших доменов?", default=False)
+        
+        if not use_cloudflare:
+            console.print("[cyan]ℹ Пропускаем настройку Cloudflare (не обязательно)[/cyan]")
+            return None
+        
+        console.print("\n[yellow]💡 Как получить Cloudflare API Token:[/yellow]")
+        console.print("1. Зайдите в Cloudflare Dashboard → My Profile → API Tokens")
+        console.print("2. Create Token → Permissions: Zone → DNS → Edit")
+        console.print("3. Zone Resources: Include → All zones")
+        console.print("4. Скопируйте токен\n")
+        
+        cloudflare_token = Prompt.ask(
+            "Введите Cloudflare API Token (или нажмите Enter чтобы пропустить)",
+            default="",
+            password=True
+        )
     
     if not cloudflare_token:
         console.print("[yellow]⚠ API Token не указан, пропускаем настройку Cloudflare[/yellow]")
@@ -50,23 +59,24 @@ def setup_dns_challenge_cloudflare():
         'provider': 'cloudflare'
     }
 
-def setup_email_rotation():
+def setup_email_rotation(base_email=None, num_accounts=None, unattended=False):
     """Настройка ротации email для обхода лимитов"""
     console.print("\n[cyan]📧 Настройка ротации email аккаунтов[/cyan]")
     console.print("[yellow]Let's Encrypt: 300 сертификатов/3 часа на аккаунт, 10 аккаунтов/IP = 3000/3 часа[/yellow]")
     
-    use_rotation = Confirm.ask(
-        "Включить автоматическую ротацию email для обхода лимитов?",
-        default=False
-    )
-    
-    if not use_rotation:
-        return None
-    
-    base_email = Prompt.ask(
-        "Введите базовый email (например: no-reply@example.com)",
-        default=""
-    )
+    if base_email is None:
+        use_rotation = not unattended and Confirm.ask(
+            "Включить автоматическую ротацию email для обхода лимитов?",
+            default=False
+        )
+        
+        if not use_rotation:
+            return None
+        
+        base_email = Prompt.ask(
+            "Введите базовый email (например: no-reply@example.com)",
+            default=""
+        )
     
     if not base_email or "@" not in base_email:
         console.print("[red]❌ Неверный формат email[/red]")
@@ -75,10 +85,11 @@ def setup_email_rotation():
     email_prefix = base_email.split("@")[0]
     email_domain = base_email.split("@")[1]
     
-    num_accounts = Prompt.ask(
-        "Сколько email аккаунтов использовать? (рекомендуется 3-10)",
-        default="3"
-    )
+    if num_accounts is None:
+        num_accounts = "3" if unattended else Prompt.ask(
+            "Сколько email аккаунтов использовать? (рекомендуется 3-10)",
+            default="3"
+        )
     
     try:
         num_accounts = int(num_accounts)
@@ -96,30 +107,31 @@ def setup_email_rotation():
         'num_accounts': num_accounts
     }
 
-def setup_tls_on_demand():
+def setup_tls_on_demand(api_url=None, unattended=False):
     """Настройка TLS on Demand для автоматического выпуска сертификатов"""
     console.print("\n[cyan]⚡ Настройка TLS on Demand[/cyan]")
     console.print("[yellow]Автоматический выпуск сертификатов при первом обращении к домену[/yellow]")
     console.print("[dim]⚠ ОПЦИОНАЛЬНО: Нужно только для 100+ доменов[/dim]")
     console.print("[dim]   Для 3-5 доменов не требуется[/dim]")
     
-    use_on_demand = Confirm.ask(
-        "Включить TLS on Demand? (полезно для большого количества доменов)",
-        default=False
-    )
-    
-    if not use_on_demand:
-        console.print("[cyan]ℹ Пропускаем TLS on Demand (не обязательно для вашего случая)[/cyan]")
-        return None
-    
-    console.print("\n[yellow]💡 TLS on Demand требует API endpoint для проверки доменов[/yellow]")
-    console.print("[dim]Пример: http://api.example.com/check?domain=example.com[/dim]")
-    console.print("[dim]API должен возвращать 200 если домен валиден[/dim]\n")
-    
-    api_url = Prompt.ask(
-        "URL API для проверки валидности домена (или Enter чтобы пропустить)",
-        default=""
-    )
+    if api_url is None:
+        use_on_demand = not unattended and Confirm.ask(
+            "Включить TLS on Demand? (полезно для большого количества доменов)",
+            default=False
+        )
+        
+        if not use_on_demand:
+            console.print("[cyan]ℹ Пропускаем TLS on Demand (не обязательно для вашего случая)[/cyan]")
+            return None
+        
+        console.print("\n[yellow]💡 TLS on Demand требует API endpoint для проверки доменов[/yellow]")
+        console.print("[dim]Пример: http://api.example.com/check?domain=example.com[/dim]")
+        console.print("[dim]API должен возвращать 200 если домен валиден[/dim]\n")
+        
+        api_url = Prompt.ask(
+            "URL API для проверки валидности домена (или Enter чтобы пропустить)",
+            default=""
+        )
     
     if not api_url:
         console.print("[yellow]⚠ API URL не указан, TLS on Demand будет отключен[/yellow]")
@@ -131,6 +143,20 @@ def setup_tls_on_demand():
         'api_url': api_url
     }
 
+def replace_with_backup(path, backup_path, content):
+    """Сохраняет текущий файл в резервную копию и атомарно записывает новое содержимое"""
+    # Резервная копия - жесткая ссылка на текущий inode, без копирования данных.
+    # После os.replace ссылка продолжает указывать на старое содержимое
+    backup_path.unlink(missing_ok=True)
+    try:
+        os.link(path, backup_path)
+    except OSError:
+        # ФС без поддержки жестких ссылок
+        shutil.copyfile(path, backup_path)
+    
+    # Права и владелец сохраняются: в .env лежит токен Cloudflare
+    write_file_atomic(path, content, keep_mode=True)
+
 def update_caddyfile_template(cloudflare_config, email_rotation, tls_on_demand):
     """Обновляет Caddyfile.template с новыми настройками"""
     template_path = Path("Caddyfile.template")
@@ -187,13 +213,12 @@ def update_caddyfile_template(cloudflare_config, email_rotation, tls_on_demand):
         
         content = re.sub(domain_pattern, add_dns_challenge, content, flags=re.MULTILINE)
     
-    if content != original_content:
+    if content is not original_content and content != original_content:
         # Создаем резервную копию
         backup_path = template_path.with_suffix('.template.backup')
-        backup_path.write_text(original_content, encoding='utf-8')
+        replace_with_backup(template_path, backup_path, content)
         console.print(f"[cyan]📋 Создана резервная копия: {backup_path.name}[/cyan]")
         
-        template_path.write_text(content, encoding='utf-8')
         console.print("[green]✓ Caddyfile.template обновлен[/green]")
         return True
     else:
@@ -208,7 +233,6 @@ def update_env_file(cloudflare_config, email_rotation):
         console.print("[yellow]⚠ .env файл не найден, создайте его через setup.py[/yellow]")
         return False
     
-    load_dotenv(env_path)
     content = env_path.read_text(encoding='utf-8')
     original_content = content
     
@@ -237,19 +261,18 @@ def update_env_file(cloudflare_config, email_rotation):
             content = re.sub(r'CADDY_EMAIL_DOMAIN=.*', f"CADDY_EMAIL_DOMAIN={email_rotation['email_domain']}", content)
             content = re.sub(r'CADDY_EMAIL_COUNT=.*', f"CADDY_EMAIL_COUNT={email_rotation['num_accounts']}", content)
     
-    if content != original_content:
+    if content is not original_content and content != original_content:
         # Создаем резервную копию
         backup_path = env_path.with_suffix('.env.backup')
-        backup_path.write_text(original_content, encoding='utf-8')
+        replace_with_backup(env_path, backup_path, content)
         console.print(f"[cyan]📋 Создана резервная копия: {backup_path.name}[/cyan]")
         
-        env_path.write_text(content, encoding='utf-8')
         console.print("[green]✓ .env файл обновлен[/green]")
         return True
     else:
         return False
 
-def create_email_rotation_script(email_rotation):
+def create_email_rotation_script(email_rotation, unattended=False):
     """Создает скрипт для автоматической ротации email"""
     if not email_rotation or not email_rotation.get('enabled'):
         return
@@ -280,6 +303,13 @@ EMAIL_COUNT = int(os.getenv("CADDY_EMAIL_COUNT", "{email_rotation['num_accounts'
 # Используем более простой путь через admin API
 CADDY_API_BASE = os.getenv("CADDY_API", "http://localhost:2019")
 
+# Путь к email в конфигурации: apps.http.servers.srv0.listen[0].tls.connection_policies[0].certificates.management.issuers[0].acme.email
+# Caddy принимает PATCH/PUT прямо по этому пути, полная конфигурация не нужна
+EMAIL_PATH = "apps/http/servers/srv0/listen/0/tls/connection_policies/0/certificates/management/issuers/0/acme/email"
+
+# Маркер: PATCH по этому пути не поддерживается, начинаем сразу с PUT
+PUT_FIRST_MARKER = PROJECT_DIR / ".caddy_email_put_first"
+
 def get_current_index():
     \"\"\"Получает текущий индекс email из файла\"\"\"
     if INDEX_FILE.exists():
@@ -293,6 +323,31 @@ def set_current_index(index):
     \"\"\"Сохраняет текущий индекс email в файл\"\"\"
     INDEX_FILE.write_text(str(index))
 
+def update_caddy_email(new_email):
+    \"\"\"Записывает email в Caddy (PATCH, при 404/405 - PUT)\"\"\"
+    url = f"{{CADDY_API_BASE}}/config/{{EMAIL_PATH}}"
+    put_first = PUT_FIRST_MARKER.exists()
+    methods = ("PUT", "PATCH") if put_first else ("PATCH", "PUT")
+    
+    statuses = []
+    for method in methods:
+        response = requests.request(method, url, json=new_email, timeout=5)
+        statuses.append(f"{{method}}: {{response.status_code}}")
+        
+        if response.status_code in [200, 204]:
+            # Запоминаем рабочий метод до следующего запуска
+            if method == "PUT" and not put_first:
+                PUT_FIRST_MARKER.touch()
+            elif method == "PATCH" and put_first:
+                PUT_FIRST_MARKER.unlink(missing_ok=True)
+            return True, statuses
+        
+        # Второй метод пробуем только если первый не поддерживается по этому пути
+        if response.status_code not in [404, 405]:
+            break
+    
+    return False, statuses
+
 def rotate_email():
     \"\"\"Ротирует email аккаунт в Caddy\"\"\"
     current_index = get_current_index()
@@ -301,40 +356,16 @@ def rotate_email():
     new_email = f"{{EMAIL_PREFIX}}{{next_index}}@{{EMAIL_DOMAIN}}"
     
     try:
-        # Получаем текущую конфигурацию Caddy
-        config_url = f"{{CADDY_API_BASE}}/config/"
-        response = requests.get(config_url, timeout=5)
-        
-        if response.status_code != 200:
-            print(f"[{{datetime.now()}}] ⚠ Не удалось подключиться к Caddy API (код: {{response.status_code}})")
-            print(f"[{{datetime.now()}}] 💡 Убедитесь, что Caddy запущен и доступен на порту 2019")
-            return False
+        updated, statuses = update_caddy_email(new_email)
         
-        # Обновляем email в глобальной секции
-        # Путь к email в конфигурации: apps.http.servers.srv0.listen[0].tls.connection_policies[0].certificates.management.issuers[0].acme.email
-        email_path = "apps/http/servers/srv0/listen/0/tls/connection_policies/0/certificates/management/issuers/0/acme/email"
-        
-        # Пробуем обновить через PATCH
-        patch_url = f"{{CADDY_API_BASE}}/config/{{email_path}}"
-        patch_response = requests.patch(patch_url, json=new_email, timeout=5)
-        
-        if patch_response.status_code in [200, 204]:
+        if updated:
             set_current_index(next_index)
             print(f"[{{datetime.now()}}] ✓ Email изменен на: {{new_email}}")
             return True
         else:
-            # Если PATCH не работает, пробуем через PUT
-            put_url = f"{{CADDY_API_BASE}}/config/{{email_path}}"
-            put_response = requests.put(put_url, json=new_email, timeout=5)
-            
-            if put_response.status_code in [200, 204]:
-                set_current_index(next_index)
-                print(f"[{{datetime.now()}}] ✓ Email изменен на: {{new_email}}")
-                return True
-            else:
-                print(f"[{{datetime.now()}}] ⚠ Ошибка при изменении email (PATCH: {{patch_response.status_code}}, PUT: {{put_response.status_code}})")
-                print(f"[{{datetime.now()}}] 💡 Возможно, нужно перезапустить Caddy или проверить конфигурацию")
-                return False
+            print(f"[{{datetime.now()}}] ⚠ Ошибка при изменении email ({{', '.join(statuses)}})")
+            print(f"[{{datetime.now()}}] 💡 Возможно, нужно перезапустить Caddy или проверить конфигурацию")
+            return False
                 
     except requests.exceptions.ConnectionError:
         print(f"[{{datetime.now()}}] ⚠ Не удалось подключиться к Caddy API")
@@ -359,7 +390,7 @@ if __name__ == "__main__":
     console.print(f"[green]✓ Абсолютный путь: {abs_script_path}[/green]")
     
     # Предлагаем автоматически добавить в cron
-    if Confirm.ask("\n[cyan]Добавить скрипт в crontab автоматически?[/cyan]", default=True):
+    if unattended or Confirm.ask("\n[cyan]Добавить скрипт в crontab автоматически?[/cyan]", default=True):
         import subprocess
         cron_line = f"*/20 * * * * cd {abs_script_path.parent} && /usr/bin/python3 {abs_script_path.name}\n"
         
@@ -394,8 +425,37 @@ if __name__ == "__main__":
     console.print(f"   [bold]crontab -e[/bold]")
     console.print(f"   [bold]*/20 * * * * cd {abs_script_path.parent} && /usr/bin/python3 {abs_script_path.name}[/bold]")
 
-def main():
+def parse_args(argv=None):
+    """Разбирает аргументы командной строки и YAML-пресет"""
+    parser = argparse.ArgumentParser(
+        description="Настройка обхода лимитов Let's Encrypt в Caddy"
+    )
+    parser.add_argument('--config', help="YAML-файл с ответами (ключи совпадают с именами флагов)")
+    parser.add_argument('--cloudflare-token', help="Cloudflare API Token для DNS Challenge")
+    parser.add_argument('--email', help="Базовый email для ротации (например: no-reply@example.com)")
+    parser.add_argument('--email-count', type=int, help="Количество email аккаунтов (1-10)")
+    parser.add_argument('--tls-ask-url', help="URL API для проверки доменов (TLS on Demand)")
+    parser.add_argument('--yes', '-y', action='store_true',
+                        help="Не задавать вопросов: неуказанные опции пропускаются")
+    args = parser.parse_args(argv)
+    
+    if args.config:
+        import yaml
+        preset = yaml.safe_load(Path(args.config).read_text(encoding='utf-8')) or {}
+        # Флаги командной строки имеют приоритет над пресетом
+        for key, value in preset.items():
+            key = key.replace('-', '_')
+            if key == 'yes':
+                args.yes = args.yes or bool(value)
+            elif hasattr(args, key) and getattr(args, key) is None:
+                setattr(args, key, value)
+    
+    return args
+
+def main(argv=None):
     """Главная функция"""
+    args = parse_args(argv)
+    
     console.print(Panel.fit(
         "[bold cyan]🔐 Настройка обхода лимитов Let's Encrypt в Caddy[/bold cyan]",
         border_style="cyan"
@@ -407,23 +467,30 @@ def main():
     console.print("3. TLS on Demand (автоматический выпуск при первом обращении)")
     console.print("4. Fallback на ZeroSSL (автоматически в Caddy)")
     
-    if not Confirm.ask("\n[cyan]Продолжить настройку?[/cyan]", default=True):
+    if not args.yes and not Confirm.ask("\n[cyan]Продолжить настройку?[/cyan]", default=True):
         return
     
     # Настройка компонентов
-    cloudflare_config = setup_dns_challenge_cloudflare()
-    email_rotation = setup_email_rotation()
-    tls_on_demand = setup_tls_on_demand()
+    cloudflare_config = setup_dns_challenge_cloudflare(args.cloudflare_token, args.yes)
+    email_rotation = setup_email_rotation(args.email, args.email_count, args.yes)
+    tls_on_demand = setup_tls_on_demand(args.tls_ask_url, args.yes)
     
     # Обновляем файлы
     console.print("\n[cyan]📝 Обновление конфигурационных файлов...[/cyan]")
     
-    caddyfile_updated = update_caddyfile_template(cloudflare_config, email_rotation, tls_on_demand)
-    env_updated = update_env_file(cloudflare_config, email_rotation)
-    
-    # Создаем скрипт ротации email
+    # Caddyfile.template и .env не зависят друг от друга - обновляем параллельно.
+    # Каждый console.print у rich атомарен, строки не перемешиваются
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        caddyfile_future = executor.submit(
+            update_caddyfile_template, cloudflare_config, email_rotation, tls_on_demand
+        )
+        env_future = executor.submit(update_env_file, cloudflare_config, email_rotation)
+        caddyfile_updated = caddyfile_future.result()
+        env_updated = env_future.result()
+    
+    # Создаем скрипт ротации email (интерактивно, поэтому после обновления файлов)
     if email_rotation:
-        create_email_rotation_script(email_rotation)
+        create_email_rotation_script(email_rotation, args.yes)
     
     console.print("\n[bold green]✅ Настройка завершена![/bold green]")
     
@@ -3,24 +3,31 @@
 Скрипт для переключения с режима портов на режим доменов (SSL)
 """
 import re
-import subprocess
 from pathlib import Path
 from rich.console import Console
 from rich.panel import Panel
 from rich.prompt import Prompt, Confirm
-from dotenv import load_dotenv
-import os
+import yaml
+
+try:
+    # LibYAML-парсер заметно быстрее чистого Python
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+from installer.utils import _truthy, update_env_values
+from installer.docker_manager import start_caddy_restart, wait_caddy_restart
 
 console = Console()
 
+_EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+_DOMAIN_RE = re.compile(r'^([a-zA-Z0-9]([a-zA-Z0-9\-]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z]{2,}$')
 
 def validate_email(email: str) -> tuple[bool, str]:
     """Проверяет валидность email"""
-    import re
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
     if not email:
         return False, "Email не может быть пустым"
-    if not re.match(pattern, email):
+    if not _EMAIL_RE.match(email):
         return False, "Неверный формат email"
     # Проверяем что это не тестовый email
     test_emails = ['test@test.test', 'test@test.com', 'example@example.com']
@@ -31,61 +38,115 @@ def validate_email(email: str) -> tuple[bool, str]:
 
 def validate_domain(domain: str) -> tuple[bool, str]:
     """Проверяет валидность домена"""
-    import re
-    pattern = r'^([a-zA-Z0-9]([a-zA-Z0-9\-]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z]{2,}$'
     if not domain:
         return False, "Домен не может быть пустым"
-    if not re.match(pattern, domain):
+    if not _DOMAIN_RE.match(domain):
         return False, "Неверный формат домена"
     return True, ""
 
 
 def read_docker_compose():
-    """Читает docker-compose.yml"""
+    """Читает docker-compose.yml (байты, чтобы не перечитывать файл для резервной копии)"""
     compose_path = Path("docker-compose.yml")
     if not compose_path.exists():
         console.print("[red]❌ Файл docker-compose.yml не найден![/red]")
         return None
-    return compose_path.read_text(encoding='utf-8')
+    return compose_path.read_bytes()
 
 
-def write_docker_compose(content):
-    """Записывает docker-compose.yml"""
+def write_docker_compose(content, original_bytes):
+    """Записывает docker-compose.yml, сохраняя original_bytes в резервную копию"""
     compose_path = Path("docker-compose.yml")
     # Создаем резервную копию
     backup_path = compose_path.with_suffix('.yml.backup')
-    if compose_path.exists():
-        backup_path.write_text(compose_path.read_text(encoding='utf-8'), encoding='utf-8')
-        console.print(f"[cyan]📋 Создана резервная копия: {backup_path.name}[/cyan]")
+    backup_path.write_bytes(original_bytes)
+    console.print(f"[cyan]📋 Создана резервная копия: {backup_path.name}[/cyan]")
     
-    compose_path.write_text(content, encoding='utf-8')
+    compose_path.write_bytes(content.encode('utf-8'))
     console.print("[green]✓ docker-compose.yml обновлен[/green]")
 
 
-def disable_ports_for_service(content, service_name):
-    """Отключает порты для сервиса (комментирует)"""
-    # Паттерн для незакомментированных портов
-    pattern = rf'(\s+{service_name}:[^\n]*\n(?:(?!\s+[a-z-]+:)[^\n]*\n)*?)(\s+)# Прямой доступ через порт.*?\n(\s+)ports:\n(\s+)\s+- "(\d+):(\d+)"'
+def _indent_of(line: str) -> int:
+    """Возвращает ширину отступа строки"""
+    return len(line) - len(line.lstrip(' '))
+
+
+def disable_ports_for_services(content, service_names):
+    """
+    Отключает порты для сервисов (комментирует) за один проход по файлу
     
-    def comment_ports(match):
-        before_ports = match.group(1)
-        indent = match.group(2)
-        indent2 = match.group(3)
-        indent3 = match.group(4)
-        external_port = match.group(5)
-        internal_port = match.group(6)
+    Идет по строкам docker-compose.yml, отслеживая по отступам текущий
+    сервис в секции services:, и заменяет его блок ports: закомментированным.
+    """
+    lines = content.splitlines(keepends=True)
+    result = []
+    in_services = False
+    service_indent = None
+    current_service = None
+    
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        stripped = line.strip()
         
-        ports_section = f'{indent}# ВАЖНО: Не открываем порт наружу напрямую! Прокси через Caddy.\n{indent2}# ports:\n{indent3}#   - "{external_port}:{internal_port}"\n'
+        if stripped and not stripped.startswith('#'):
+            indent = _indent_of(line)
+            if indent == 0:
+                # Ключ верхнего уровня: services:, volumes:, networks: ...
+                in_services = stripped == 'services:'
+                service_indent = None
+                current_service = None
+            elif in_services and (service_indent is None or indent <= service_indent):
+                # Заголовок сервиса
+                service_indent = indent
+                name = stripped[:-1] if stripped.endswith(':') else None
+                current_service = name if name in service_names else None
+            elif current_service and stripped == 'ports:':
+                # Собираем элементы списка портов
+                end = i + 1
+                while end < len(lines) and lines[end].strip().startswith('-') and _indent_of(lines[end]) >= indent:
+                    end += 1
+                
+                if end > i + 1:
+                    # Комментарий "Прямой доступ через порт" заменяем предупреждением
+                    if result and result[-1].strip().startswith('# Прямой доступ через порт'):
+                        result.pop()
+                    
+                    pad = line[:indent]
+                    result.append(f'{pad}# ВАЖНО: Не открываем порт наружу напрямую! Прокси через Caddy.\n')
+                    result.append(f'{pad}# ports:\n')
+                    for item in lines[i + 1:end]:
+                        result.append(f'{pad}#   {item.strip()}\n')
+                    
+                    console.print(f"[green]✓ Порт отключен для {current_service}[/green]")
+                    i = end
+                    continue
         
-        return f'{before_ports}{ports_section}'
+        result.append(line)
+        i += 1
     
-    new_content = re.sub(pattern, comment_ports, content, flags=re.MULTILINE)
+    return ''.join(result)
+
+
+def validate_docker_compose(content, service_names):
+    """
+    Проверяет docker-compose.yml после правки
     
-    if new_content != content:
-        console.print(f"[green]✓ Порт отключен для {service_name}[/green]")
-        return new_content
+    Файл правится построчно, чтобы сохранить комментарии (по ним switch_to_ports.py
+    восстанавливает порты), поэтому результат разбираем YAML-парсером перед записью.
+    """
+    try:
+        data = yaml.load(content, Loader=YamlLoader) or {}
+    except yaml.YAMLError as e:
+        console.print(f"[red]❌ Ошибка синтаксиса docker-compose.yml после изменений: {e}[/red]")
+        return False
+    
+    services = data.get('services') or {}
+    for name in service_names:
+        if 'ports' in (services.get(name) or {}):
+            console.print(f"[yellow]⚠ Не удалось автоматически отключить порт для {name}[/yellow]")
     
-    return content
+    return True
 
 
 def main():
@@ -106,11 +167,12 @@ def main():
         return
     
     # Загружаем текущую конфигурацию
+    from dotenv import load_dotenv
     load_dotenv()
     
     # Проверяем какие сервисы включены
-    n8n_enabled = os.getenv('N8N_ENABLED', 'true').lower() in ('true', '1', 'yes', 'on')
-    langflow_enabled = os.getenv('LANGFLOW_ENABLED', 'true').lower() in ('true', '1', 'yes', 'on')
+    n8n_enabled = _truthy('N8N_ENABLED', True)
+    langflow_enabled = _truthy('LANGFLOW_ENABLED', True)
     
     # Настройка доменов
     console.print("\n[bold cyan]📝 Настройка доменов[/bold cyan]")
@@ -180,76 +242,49 @@ def main():
     console.print("\n[cyan]Шаг 1: Обновление .env[/cyan]")
     env_path = Path(".env")
     if env_path.exists():
-        env_content = env_path.read_text(encoding='utf-8')
+        env_content = env_path.read_bytes().decode('utf-8')
+        
+        updates = {}
         
         # Обновляем домены
         if n8n_enabled:
-            env_content = re.sub(
-                r'^N8N_DOMAIN=.*$',
-                f"N8N_DOMAIN={domains.get('n8n_domain', '')}",
-                env_content,
-                flags=re.MULTILINE
-            )
+            updates['N8N_DOMAIN'] = domains.get('n8n_domain', '')
         
         if langflow_enabled:
-            env_content = re.sub(
-                r'^LANGFLOW_DOMAIN=.*$',
-                f"LANGFLOW_DOMAIN={domains.get('langflow_domain', '')}",
-                env_content,
-                flags=re.MULTILINE
-            )
+            updates['LANGFLOW_DOMAIN'] = domains.get('langflow_domain', '')
         
-        env_content = re.sub(
-            r'^SUPABASE_DOMAIN=.*$',
-            f"SUPABASE_DOMAIN={domains.get('supabase_domain', '')}",
-            env_content,
-            flags=re.MULTILINE
-        )
+        updates['SUPABASE_DOMAIN'] = domains.get('supabase_domain', '')
         
         # Обновляем routing_mode
-        env_content = re.sub(
-            r'^ROUTING_MODE=.*$',
-            "ROUTING_MODE=subdomain",
-            env_content,
-            flags=re.MULTILINE
-        )
+        updates['ROUTING_MODE'] = 'subdomain'
         
         # Обновляем SSL настройки
         if email:
-            env_content = re.sub(
-                r'^LETSENCRYPT_EMAIL=.*$',
-                f"LETSENCRYPT_EMAIL={email}",
-                env_content,
-                flags=re.MULTILINE
-            )
-            env_content = re.sub(
-                r'^LETSENCRYPT_STAGING=.*$',
-                f"LETSENCRYPT_STAGING={'true' if use_staging else 'false'}",
-                env_content,
-                flags=re.MULTILINE
-            )
-            env_content = re.sub(
-                r'^SSL_ENABLED=.*$',
-                "SSL_ENABLED=true",
-                env_content,
-                flags=re.MULTILINE
-            )
+            updates['LETSENCRYPT_EMAIL'] = email
+            updates['LETSENCRYPT_STAGING'] = 'true' if use_staging else 'false'
+            updates['SSL_ENABLED'] = 'true'
         
-        env_path.write_text(env_content, encoding='utf-8')
+        env_content = update_env_values(env_content, updates)
+        env_path.write_bytes(env_content.encode('utf-8'))
         console.print("[green]✓ .env обновлен[/green]")
     else:
         console.print("[yellow]⚠ Файл .env не найден[/yellow]")
     
     # Отключаем порты в docker-compose.yml
     console.print("\n[cyan]Шаг 2: Отключение прямых портов[/cyan]")
-    content = read_docker_compose()
-    if content:
+    original_bytes = read_docker_compose()
+    if original_bytes:
+        content = original_bytes.decode('utf-8')
+        services = ['supabase-studio']
         if n8n_enabled:
-            content = disable_ports_for_service(content, 'n8n')
+            services.append('n8n')
         if langflow_enabled:
-            content = disable_ports_for_service(content, 'langflow')
-        content = disable_ports_for_service(content, 'supabase-studio')
-        write_docker_compose(content)
+            services.append('langflow')
+        content = disable_ports_for_services(content, services)
+        if validate_docker_compose(content, services):
+            write_docker_compose(content, original_bytes)
+        else:
+            console.print("[yellow]⚠ docker-compose.yml оставлен без изменений[/yellow]")
     
     # Перегенерируем Caddyfile
     console.print("\n[cyan]Шаг 3: Перегенерация Caddyfile[/cyan]")
@@ -264,17 +299,10 @@ def main():
     
     # Перезапускаем сервисы
     console.print("\n[cyan]Шаг 4: Перезапуск сервисов[/cyan]")
+    restart_process = None
     if Confirm.ask("Перезапустить сервисы? (y/n)", default=True):
-        try:
-            subprocess.run(
-                ["docker-compose", "restart", "caddy"],
-                check=True,
-                timeout=30
-            )
-            console.print("[green]✓ Caddy перезапущен[/green]")
-        except Exception as e:
-            console.print(f"[yellow]⚠ Не удалось перезапустить Caddy: {e}[/yellow]")
-            console.print("[cyan]💡 Запустите вручную: docker-compose restart caddy[/cyan]")
+        # Перезапуск идет в фоне, пока выводим следующие шаги
+        restart_process = start_caddy_restart()
     
     console.print("\n[bold green]✅ Готово![/bold green]")
     console.print("\n[cyan]💡 Следующие шаги:[/cyan]")
@@ -286,6 +314,10 @@ def main():
     if use_staging:
         console.print("\n[yellow]⚠ Внимание: Staging сертификаты НЕ доверяются браузерами![/yellow]")
         console.print("[yellow]⚠ Для продакшена переключитесь на Production[/yellow]")
+    
+    if restart_process:
+        console.print()
+        wait_caddy_restart(restart_process)
 
 
 if __name__ == "__main__":
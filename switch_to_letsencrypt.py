@@ -5,74 +5,102 @@ Let's Encrypt работает без проблем с DNS и не требуе
 """
 import os
 import re
+import shutil
 from pathlib import Path
 from rich.console import Console
 from rich.panel import Panel
 from rich.prompt import Confirm
 
+from installer.caddy_patterns import EMAIL_LINE_RE, find_global_block
+from installer.docker_manager import start_caddy_restart, wait_caddy_restart
+from installer.utils import _truthy
+
 console = Console()
 
+_PROJECT_ROOT: Path = Path(__file__).resolve().parent
+
+# Ключи конфигурации Caddyfile: (ключ config, переменная .env, тип, значение по умолчанию)
+_CONFIG_KEYS = (
+    ('routing_mode', 'ROUTING_MODE', str, ''),
+    ('letsencrypt_email', 'LETSENCRYPT_EMAIL', str, ''),
+    ('n8n_enabled', 'N8N_ENABLED', bool, False),
+    ('langflow_enabled', 'LANGFLOW_ENABLED', bool, False),
+    ('ollama_enabled', 'OLLAMA_ENABLED', bool, False),
+    ('n8n_domain', 'N8N_DOMAIN', str, ''),
+    ('langflow_domain', 'LANGFLOW_DOMAIN', str, ''),
+    ('supabase_domain', 'SUPABASE_DOMAIN', str, ''),
+    ('ollama_domain', 'OLLAMA_DOMAIN', str, ''),
+    ('supabase_admin_login', 'SUPABASE_ADMIN_LOGIN', str, 'admin'),
+    ('supabase_admin_password_hash', 'SUPABASE_ADMIN_PASSWORD_HASH', str, ''),
+)
+
+# Директивы acme_ca и комментарии про другие CA в глобальном блоке
+_CLEANUP_RE = re.compile(
+    r"^[ \t]*(?:acme_ca[ \t]+[^\n]+|# (?:ZeroSSL|Buypass|Let's Encrypt Staging|Переключено на|Решение проблемы)[^\n]*)\n?",
+    re.MULTILINE
+)
+
 
 def get_project_root() -> Path:
     """Возвращает корневую директорию проекта"""
-    return Path(__file__).parent
+    return _PROJECT_ROOT
 
 
 def switch_to_letsencrypt():
     """Переключает Caddyfile на использование Let's Encrypt (по умолчанию)"""
-    caddyfile_path = get_project_root() / "Caddyfile"
-    caddyfile_template_path = get_project_root() / "Caddyfile.template"
+    caddyfile_path = _PROJECT_ROOT / "Caddyfile"
+    caddyfile_template_path = _PROJECT_ROOT / "Caddyfile.template"
     
-    # Проверяем наличие файлов
-    if not caddyfile_path.exists() and not caddyfile_template_path.exists():
+    # Работаем с шаблоном (основной файл), иначе с Caddyfile.
+    # Открываем файл сразу, без предварительных проверок exists()
+    for target_file in (caddyfile_template_path, caddyfile_path):
+        try:
+            raw = target_file.read_bytes()
+            break
+        except FileNotFoundError:
+            continue
+    else:
         console.print("[red]❌ Caddyfile или Caddyfile.template не найдены![/red]")
         console.print("[yellow]💡 Сначала запустите setup.py для генерации конфигурации[/yellow]")
         return False
     
-    # Работаем с шаблоном (основной файл)
-    target_file = caddyfile_template_path if caddyfile_template_path.exists() else caddyfile_path
-    
-    content = target_file.read_text(encoding='utf-8')
-    original_content = content
-    
     console.print("[cyan]🔄 Переключение на Let's Encrypt...[/cyan]")
     
-    # Удаляем acme_ca (Let's Encrypt используется по умолчанию в Caddy)
-    # Ищем глобальный блок { ... }
-    global_block_pattern = r'(\{\s*\n)(\s*email\s+\{[^}]+\}\s*\n?)(.*?)(\})'
+    content = raw.decode('utf-8')
+    del raw
     
-    def remove_acme_ca(match):
-        header = match.group(1)  # "{\n"
-        email_line = match.group(2)  # "    email {CADDY_EMAIL}\n"
-        rest = match.group(3)  # остальное содержимое
-        footer = match.group(4)  # "}"
-        
-        # Удаляем все acme_ca директивы
-        rest = re.sub(r'\s+acme_ca\s+[^\n]+\n?', '', rest)
+    # Ищем глобальный блок { ... } подсчетом вложенных скобок
+    block = find_global_block(content)
+    email = block and EMAIL_LINE_RE.match(content, *block)
+    
+    # Изменения отслеживаем по самому глобальному блоку, а не сравнением всего файла
+    changed = False
+    if email:
+        start, end = block
         
-        # Удаляем комментарии про другие CA
-        rest = re.sub(r'\s+# ZeroSSL.*?\n', '', rest, flags=re.MULTILINE)
-        rest = re.sub(r'\s+# Buypass.*?\n', '', rest, flags=re.MULTILINE)
-        rest = re.sub(r'\s+# Переключено на.*?\n', '', rest, flags=re.MULTILINE)
-        rest = re.sub(r'\s+# Решение проблемы.*?\n', '', rest, flags=re.MULTILINE)
+        # Удаляем все acme_ca директивы и комментарии про другие CA за один проход
+        # (Let's Encrypt используется по умолчанию в Caddy)
+        rest = _CLEANUP_RE.sub('', content[email.end():end])
         
         # Добавляем комментарий про Let's Encrypt
         if '# Let\'s Encrypt' not in rest and '# Caddy автоматически' not in rest:
             rest = '    # Let\'s Encrypt - используется по умолчанию в Caddy\n' + rest
             rest += '    # Caddy автоматически получает сертификаты и перенаправляет HTTP на HTTPS\n'
         
-        return f"{header}{email_line}{rest}{footer}"
+        body = email.group(0) + rest
+        # Новый текст файла собираем, только если блок действительно изменился
+        changed = body != content[start:end]
+        if changed:
+            content = content[:start] + body + content[end:]
     
-    content = re.sub(global_block_pattern, remove_acme_ca, content, flags=re.DOTALL)
-    
-    if content != original_content:
+    if changed:
         # Создаем резервную копию
         backup_path = target_file.with_suffix(target_file.suffix + '.backup')
-        backup_path.write_text(original_content, encoding='utf-8')
+        shutil.copyfile(target_file, backup_path)
         console.print(f"[cyan]📋 Создана резервная копия: {backup_path.name}[/cyan]")
         
         # Сохраняем изменения
-        target_file.write_text(content, encoding='utf-8')
+        target_file.write_bytes(content.encode('utf-8'))
         console.print(f"[green]✓ {target_file.name} обновлен на Let's Encrypt[/green]")
         return True
     else:
@@ -90,23 +118,26 @@ def clear_old_certificates():
     try:
         import subprocess
         
-        # Останавливаем Caddy
-        console.print("   Остановка Caddy...")
-        subprocess.run(
-            ['docker-compose', 'stop', 'caddy'],
-            capture_output=True,
-            check=False
-        )
-        
-        # Очищаем старые сертификаты
+        # Очищаем старые сертификаты в уже запущенном контейнере: без остановки
+        # и создания временного контейнера, Caddy все равно перезапускается следом
         console.print("   Удаление старых сертификатов...")
+        clear_cmd = ['sh', '-c', 'rm -rf /data/caddy/acme/*']
         result = subprocess.run(
-            ['docker-compose', 'run', '--rm', 'caddy', 'sh', '-c', 'rm -rf /data/caddy/acme/*'],
+            ['docker-compose', 'exec', '-T', 'caddy', *clear_cmd],
             capture_output=True,
             text=True,
             check=False
         )
         
+        if result.returncode != 0:
+            # Контейнер не запущен - удаляем через временный контейнер
+            result = subprocess.run(
+                ['docker-compose', 'run', '--rm', 'caddy', *clear_cmd],
+                capture_output=True,
+                text=True,
+                check=False
+            )
+        
         if result.returncode == 0:
             console.print("[green]✓ Старые сертификаты удалены[/green]")
             return True
@@ -129,24 +160,21 @@ def regenerate_caddyfile():
     except ImportError:
         try:
             from installer.config_generator import generate_caddyfile
-            from dotenv import load_dotenv
-            import os
+            from dotenv import dotenv_values
             
-            load_dotenv()
+            # Один разбор .env в словарь, без записи в os.environ.
+            # Переменные окружения, как и при load_dotenv(), имеют приоритет
+            env = {
+                key: value
+                for key, value in dotenv_values(get_project_root() / ".env").items()
+                if value is not None
+            }
+            env.update(os.environ)
             
             # Загружаем конфигурацию из .env
             config = {
-                'routing_mode': os.getenv('ROUTING_MODE', ''),
-                'letsencrypt_email': os.getenv('LETSENCRYPT_EMAIL', ''),
-                'n8n_enabled': os.getenv('N8N_ENABLED', 'false').lower() == 'true',
-                'langflow_enabled': os.getenv('LANGFLOW_ENABLED', 'false').lower() == 'true',
-                'ollama_enabled': os.getenv('OLLAMA_ENABLED', 'false').lower() == 'true',
-                'n8n_domain': os.getenv('N8N_DOMAIN', ''),
-                'langflow_domain': os.getenv('LANGFLOW_DOMAIN', ''),
-                'supabase_domain': os.getenv('SUPABASE_DOMAIN', ''),
-                'ollama_domain': os.getenv('OLLAMA_DOMAIN', ''),
-                'supabase_admin_login': os.getenv('SUPABASE_ADMIN_LOGIN', 'admin'),
-                'supabase_admin_password_hash': os.getenv('SUPABASE_ADMIN_PASSWORD_HASH', ''),
+                key: _truthy(env_key, default, env) if kind is bool else env.get(env_key, default)
+                for key, env_key, kind, default in _CONFIG_KEYS
             }
             
             generate_caddyfile(config)
@@ -197,24 +225,9 @@ def main():
     clear_old_certificates()
     
     # 4. Перезапускаем Caddy
+    # Перезапуск идет в фоне, пока выводим следующие шаги
     console.print("\n[cyan]🔄 Перезапуск Caddy...[/cyan]")
-    try:
-        import subprocess
-        result = subprocess.run(
-            ['docker-compose', 'restart', 'caddy'],
-            capture_output=True,
-            text=True,
-            check=False
-        )
-        
-        if result.returncode == 0:
-            console.print("[green]✓ Caddy перезапущен[/green]")
-        else:
-            console.print("[yellow]⚠ Не удалось перезапустить Caddy автоматически[/yellow]")
-            console.print("[cyan]💡 Запустите вручную: docker-compose restart caddy[/cyan]")
-    except Exception as e:
-        console.print(f"[yellow]⚠ Ошибка при перезапуске Caddy: {e}[/yellow]")
-        console.print("[cyan]💡 Запустите вручную: docker-compose restart caddy[/cyan]")
+    restart_process = start_caddy_restart()
     
     console.print("\n[bold green]✅ Переключение на Let's Encrypt завершено![/bold green]")
     console.print("\n[cyan]💡 Следующие шаги:[/cyan]")
@@ -225,6 +238,10 @@ def main():
     console.print("- Убедитесь, что DNS записи правильно настроены")
     console.print("- Проверьте, что порты 80 и 443 открыты")
     console.print("- Если лимиты исчерпаны - подождите 7 дней или используйте staging")
+    
+    if restart_process:
+        console.print()
+        wait_caddy_restart(restart_process)
 
 
 if __name__ == "__main__":
@@ -3,62 +3,76 @@
 Скрипт для переключения Caddy на Let's Encrypt Staging
 Staging среда имеет более высокие лимиты для тестирования
 """
-import os
 import re
 from pathlib import Path
 from rich.console import Console
 from rich.panel import Panel
 from rich.prompt import Confirm
 
+from installer.caddy_patterns import EMAIL_LINE_RE, find_global_block
+
 console = Console()
 
+_PROJECT_ROOT: Path = Path(__file__).resolve().parent
+
+# Директивы acme_ca и комментарии про SSL в глобальном блоке
+_CLEANUP_RE = re.compile(
+    r"^[ \t]*(?:acme_ca[ \t]+[^\n]+|# [^\n]*SSL[^\n]*|# Let's Encrypt Staging[^\n]*)\n?",
+    re.MULTILINE
+)
+
 
 def get_project_root() -> Path:
     """Возвращает корневую директорию проекта"""
-    return Path(__file__).parent
+    return _PROJECT_ROOT
 
 
 def switch_to_staging():
     """Переключает Caddyfile на использование Let's Encrypt Staging"""
-    caddyfile_path = get_project_root() / "Caddyfile"
-    caddyfile_template_path = get_project_root() / "Caddyfile.template"
-    
-    target_file = caddyfile_template_path if caddyfile_template_path.exists() else caddyfile_path
+    caddyfile_path = _PROJECT_ROOT / "Caddyfile"
+    caddyfile_template_path = _PROJECT_ROOT / "Caddyfile.template"
     
-    if not target_file.exists():
+    # Открываем файл сразу, без предварительных проверок exists()
+    for target_file in (caddyfile_template_path, caddyfile_path):
+        try:
+            raw = target_file.read_bytes()
+            break
+        except FileNotFoundError:
+            continue
+    else:
         console.print("[red]❌ Caddyfile не найден![/red]")
         return False
     
-    content = target_file.read_text(encoding='utf-8')
-    original_content = content
-    
     console.print("[cyan]🔄 Переключение на Let's Encrypt Staging...[/cyan]")
     
-    # Заменяем acme_ca на staging
-    global_block_pattern = r'(\{\s*\n)(\s*email\s+\{[^}]+\}\s*\n?)(.*?)(\})'
+    content = raw.decode('utf-8')
     
-    def add_staging(match):
-        header = match.group(1)
-        email_line = match.group(2)
-        rest = match.group(3)
-        footer = match.group(4)
+    # Ищем глобальный блок { ... } подсчетом вложенных скобок
+    block = find_global_block(content)
+    email = block and EMAIL_LINE_RE.match(content, *block)
+    
+    # Изменения отслеживаем по самому глобальному блоку, а не сравнением всего файла
+    changed = False
+    if email:
+        start, end = block
         
-        # Удаляем все старые acme_ca
-        rest = re.sub(r'\s+acme_ca\s+[^\n]+\n?', '', rest)
-        rest = re.sub(r'\s+# .*SSL.*?\n', '', rest, flags=re.MULTILINE)
+        # Удаляем все старые acme_ca и комментарии про SSL за один проход
+        rest = _CLEANUP_RE.sub('', content[email.end():end])
         
         # Добавляем Let's Encrypt Staging
         staging_config = '    # Let\'s Encrypt Staging - более высокие лимиты для тестирования\n'
         staging_config += '    acme_ca https://acme-staging-v02.api.letsencrypt.org/directory\n'
         
-        rest = staging_config + rest
-        return f"{header}{email_line}{rest}{footer}"
-    
-    content = re.sub(global_block_pattern, add_staging, content, flags=re.DOTALL)
+        body = email.group(0) + staging_config + rest
+        # Новый текст файла собираем, только если блок действительно изменился
+        changed = body != content[start:end]
+        if changed:
+            content = content[:start] + body + content[end:]
     
-    if content != original_content:
+    if changed:
+        # Резервная копия из уже прочитанных байтов, без повторного чтения файла
         backup_path = target_file.with_suffix(target_file.suffix + '.backup')
-        backup_path.write_text(original_content, encoding='utf-8')
+        backup_path.write_bytes(raw)
         console.print(f"[cyan]📋 Создана резервная копия: {backup_path.name}[/cyan]")
         
         target_file.write_text(content, encoding='utf-8')
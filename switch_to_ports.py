@@ -3,7 +3,6 @@
 Скрипт для переключения с режима доменов на режим портов (без SSL)
 Полезно когда нужно работать сразу, без ожидания SSL сертификатов
 """
-import re
 import subprocess
 from pathlib import Path
 from rich.console import Console
@@ -11,111 +10,126 @@ from rich.panel import Panel
 from rich.prompt import Confirm
 from dotenv import load_dotenv
 import os
+import yaml
+
+try:
+    # LibYAML-парсер заметно быстрее чистого Python
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+from installer.compose_patterns import (
+    COMMENTED_PORTS_RE, DEPLOY_RE, ENABLED_PORTS_RE, service_blocks
+)
+from installer.docker_manager import get_docker_compose_command
+from installer.utils import update_env_values
 
 console = Console()
 
 
 def read_docker_compose():
-    """Читает docker-compose.yml"""
+    """Читает docker-compose.yml (байты, чтобы не перечитывать файл для резервной копии)"""
     compose_path = Path("docker-compose.yml")
     if not compose_path.exists():
         console.print("[red]❌ Файл docker-compose.yml не найден![/red]")
         return None
-    return compose_path.read_text(encoding='utf-8')
+    return compose_path.read_bytes()
 
 
-def write_docker_compose(content):
-    """Записывает docker-compose.yml"""
+def write_docker_compose(content, original_bytes):
+    """Записывает docker-compose.yml, сохраняя original_bytes в резервную копию"""
     compose_path = Path("docker-compose.yml")
     # Создаем резервную копию
     backup_path = compose_path.with_suffix('.yml.backup')
-    if compose_path.exists():
-        backup_path.write_text(compose_path.read_text(encoding='utf-8'), encoding='utf-8')
-        console.print(f"[cyan]📋 Создана резервная копия: {backup_path.name}[/cyan]")
+    backup_path.write_bytes(original_bytes)
+    console.print(f"[cyan]📋 Создана резервная копия: {backup_path.name}[/cyan]")
     
-    compose_path.write_text(content, encoding='utf-8')
+    compose_path.write_bytes(content.encode('utf-8'))
     console.print("[green]✓ docker-compose.yml обновлен[/green]")
 
 
-def enable_ports_for_service(content, service_name, port_env_var, default_port):
-    """Включает порты для сервиса"""
-    # Загружаем .env для получения портов
-    load_dotenv()
-    port = os.getenv(port_env_var, default_port)
-    
-    if not port:
-        port = default_port
+def enable_ports_for_services(content, services, env):
+    """
+    Включает порты для сервисов
     
-    # Проверяем, есть ли уже незакомментированная секция ports
-    if re.search(rf'^\s+{service_name}:[^\n]*\n(?:[^\n]*\n)*?\s+ports:\s*$', content, re.MULTILINE):
-        console.print(f"[cyan]ℹ Порт уже включен для {service_name}, пропускаем[/cyan]")
+    services: {имя сервиса: (переменная с портом в .env, порт по умолчанию)}
+    env: уже загруженные переменные окружения
+    Файл один раз делится на блоки сервисов, и короткие паттерны ищутся
+    только внутри блока нужного сервиса.
+    """
+    # Дешевая проверка подстрокой: если ни одного сервиса в файле нет,
+    # не разбираем его на блоки
+    if not any(f"{name}:" in content for name in services):
+        for name in services:
+            console.print(f"[yellow]⚠ Не удалось автоматически включить порт для {name}[/yellow]")
         return content
     
-    # Паттерн 1: стандартный формат с комментарием "ВАЖНО: Не открываем порт..."
-    pattern1 = rf'(\s+{service_name}:[^\n]*\n(?:(?!\s+[a-z-]+:)[^\n]*\n)*?)(\s+)# ВАЖНО: Не открываем порт наружу напрямую! Прокси через Caddy\.\n(\s+)# ports:\n(\s+)#\s+- "[^"]+":(\d+)'
+    blocks = service_blocks(content)
+    edits = []
     
-    def replace_commented_ports1(match):
-        before_comment = match.group(1)
-        indent = match.group(2)
-        indent2 = match.group(3)
-        indent3 = match.group(4)
-        internal_port_found = match.group(5)
+    for name, (port_env_var, default_port) in services.items():
+        port = env.get(port_env_var) or default_port
+        if name not in blocks:
+            console.print(f"[yellow]⚠ Не удалось автоматически включить порт для {name}[/yellow]")
+            continue
+        start, end = blocks[name]
         
-        # Используем найденный внутренний порт или дефолтный
-        internal = internal_port_found if internal_port_found else default_port
+        # Паттерны про ports запускаем, только если в блоке вообще есть "ports:"
+        has_ports = content.find('ports:', start, end) != -1
         
-        ports_section = f'{indent}# Прямой доступ через порт (режим без доменов)\n{indent2}ports:\n{indent3}  - "{port}:{internal}"\n'
+        # Проверяем, есть ли уже незакомментированная секция ports
+        if has_ports and ENABLED_PORTS_RE.search(content, start, end):
+            console.print(f"[cyan]ℹ Порт уже включен для {name}, пропускаем[/cyan]")
+            continue
         
-        return f'{before_comment}{ports_section}'
-    
-    new_content = re.sub(pattern1, replace_commented_ports1, content, flags=re.MULTILINE)
-    
-    if new_content != content:
-        console.print(f"[green]✓ Порт {port} включен для {service_name}[/green]")
-        return new_content
-    
-    # Паттерн 2: любой закомментированный блок ports
-    pattern2 = rf'(\s+{service_name}:[^\n]*\n(?:(?!\s+[a-z-]+:)[^\n]*\n)*?)(\s+)#.*[пп]орт.*\n(\s+)#\s+ports:\n(\s+)#\s+- "[^"]+":(\d+)'
-    
-    def replace_commented_ports2(match):
-        before_comment = match.group(1)
-        indent = match.group(2)
-        indent2 = match.group(3)
-        indent3 = match.group(4)
-        internal_port_found = match.group(5)
-        
-        internal = internal_port_found if internal_port_found else default_port
-        
-        ports_section = f'{indent}# Прямой доступ через порт (режим без доменов)\n{indent2}ports:\n{indent3}  - "{port}:{internal}"\n'
+        # Раскомментируем найденный блок ports, сохраняя внутренний порт
+        match = has_ports and COMMENTED_PORTS_RE.search(content, start, end)
+        if match:
+            indent, indent2, indent3, internal = match.groups()
+            ports_section = f'{indent}# Прямой доступ через порт (режим без доменов)\n{indent2}ports:\n{indent3}  - "{port}:{internal}"\n'
+        else:
+            # Закомментированных портов нет — вставляем перед deploy
+            match = content.find('deploy:', start, end) != -1 and DEPLOY_RE.search(content, start, end)
+            if not match:
+                console.print(f"[yellow]⚠ Не удалось автоматически включить порт для {name}[/yellow]")
+                continue
+            indent = match.group(1)
+            ports_section = f'{indent}# Прямой доступ через порт (режим без доменов)\n{indent}ports:\n{indent}  - "{port}:{default_port}"\n{match.group(0)}'
         
-        return f'{before_comment}{ports_section}'
-    
-    new_content = re.sub(pattern2, replace_commented_ports2, content, flags=re.MULTILINE)
-    
-    if new_content != content:
-        console.print(f"[green]✓ Порт {port} включен для {service_name}[/green]")
-        return new_content
+        edits.append((match.start(), match.end(), ports_section))
+        console.print(f"[green]✓ Порт {port} включен для {name}[/green]")
     
-    # Паттерн 3: вставляем перед deploy (если закомментированных портов нет)
-    pattern3 = rf'(\s+{service_name}:[^\n]*\n(?:(?!\s+deploy:)[^\n]*\n)*?)(\s+)(deploy:)'
+    # Собираем результат из неизменённых кусков и замен
+    parts = []
+    position = 0
+    for start, end, replacement in sorted(edits):
+        parts.append(content[position:start])
+        parts.append(replacement)
+        position = end
+    parts.append(content[position:])
+    return ''.join(parts)
+
+
+def validate_docker_compose(content, service_names):
+    """
+    Проверяет docker-compose.yml после правки
     
-    def insert_before_deploy(match):
-        before_deploy = match.group(1)
-        indent = match.group(2)
-        deploy_section = match.group(3)
-        
-        ports_section = f'{indent}# Прямой доступ через порт (режим без доменов)\n{indent}ports:\n{indent}  - "{port}:{default_port}"\n'
-        
-        return f'{before_deploy}{ports_section}{indent}{deploy_section}'
+    Порты восстанавливаются из закомментированных блоков, которые YAML-парсер
+    не видит, поэтому файл правится как текст, а результат разбирается парсером
+    перед записью.
+    """
+    try:
+        data = yaml.load(content, Loader=YamlLoader) or {}
+    except yaml.YAMLError as e:
+        console.print(f"[red]❌ Ошибка синтаксиса docker-compose.yml после изменений: {e}[/red]")
+        return False
     
-    new_content = re.sub(pattern3, insert_before_deploy, content, flags=re.MULTILINE)
+    services = data.get('services') or {}
+    for name in service_names:
+        if 'ports' not in (services.get(name) or {}):
+            console.print(f"[yellow]⚠ Порт для {name} не найден в итоговой конфигурации[/yellow]")
     
-    if new_content != content:
-        console.print(f"[green]✓ Порт {port} включен для {service_name}[/green]")
-        return new_content
-    else:
-        console.print(f"[yellow]⚠ Не удалось автоматически включить порт для {service_name}[/yellow]")
-        return content
+    return True
 
 
 def main():
@@ -155,46 +169,48 @@ def main():
     console.print("\n[cyan]Шаг 1: Обновление .env[/cyan]")
     env_path = Path(".env")
     if env_path.exists():
-        env_content = env_path.read_text(encoding='utf-8')
-        
-        # Обновляем routing_mode
-        env_content = re.sub(
-            r'^ROUTING_MODE=.*$',
-            "ROUTING_MODE=none",
-            env_content,
-            flags=re.MULTILINE
-        )
+        original_env = env_path.read_bytes().decode('utf-8')
         
-        # Отключаем SSL
-        env_content = re.sub(
-            r'^SSL_ENABLED=.*$',
-            "SSL_ENABLED=false",
-            env_content,
-            flags=re.MULTILINE
-        )
+        # Обновляем routing_mode и отключаем SSL
+        env_content = update_env_values(original_env, {
+            'ROUTING_MODE': 'none',
+            'SSL_ENABLED': 'false',
+        })
         
-        env_path.write_text(env_content, encoding='utf-8')
-        console.print("[green]✓ .env обновлен[/green]")
+        if env_content != original_env:
+            env_path.write_bytes(env_content.encode('utf-8'))
+            console.print("[green]✓ .env обновлен[/green]")
+        else:
+            console.print("[cyan]ℹ .env уже настроен на режим портов[/cyan]")
     else:
         console.print("[yellow]⚠ Файл .env не найден[/yellow]")
     
     # Включаем порты в docker-compose.yml
     console.print("\n[cyan]Шаг 2: Включение прямых портов[/cyan]")
-    content = read_docker_compose()
-    if content:
+    original_bytes = read_docker_compose()
+    if original_bytes:
+        content = original_bytes.decode('utf-8')
+        services = {}
         if n8n_enabled:
-            content = enable_ports_for_service(content, 'n8n', 'N8N_PORT', '5678')
+            services['n8n'] = ('N8N_PORT', '5678')
         if langflow_enabled:
-            content = enable_ports_for_service(content, 'langflow', 'LANGFLOW_PORT', '7860')
-        content = enable_ports_for_service(content, 'supabase-studio', 'SUPABASE_KB_PORT', '3000')
-        write_docker_compose(content)
+            services['langflow'] = ('LANGFLOW_PORT', '7860')
+        services['supabase-studio'] = ('SUPABASE_KB_PORT', '3000')
+        content = enable_ports_for_services(content, services, os.environ)
+        if validate_docker_compose(content, services):
+            write_docker_compose(content, original_bytes)
+        else:
+            console.print("[yellow]⚠ docker-compose.yml оставлен без изменений[/yellow]")
     
     # Проверяем синтаксис YAML
     console.print("\n[cyan]Шаг 3: Проверка синтаксиса docker-compose.yml...[/cyan]")
+    compose_cmd = get_docker_compose_command()
     try:
+        # --quiet: только код возврата и ошибки, без вывода итогового YAML
         result = subprocess.run(
-            ["docker-compose", "config"],
-            capture_output=True,
+            [*compose_cmd, "config", "--quiet"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
             text=True,
             timeout=10
         )
@@ -216,7 +232,7 @@ def main():
     if Confirm.ask("Перезапустить сервисы? (y/n)", default=True):
         try:
             subprocess.run(
-                ["docker-compose", "up", "-d"],
+                [*compose_cmd, "up", "-d"],
                 check=True,
                 timeout=60
             )
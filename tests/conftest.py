@@ -0,0 +1,7 @@
+"""
+Общие настройки тестов: корень проекта в sys.path для импорта скриптов
+"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,43 @@
+"""
+Тесты setup_caddy_ssl_workarounds.py
+"""
+import os
+import stat
+
+import setup_caddy_ssl_workarounds
+
+
+def test_replace_with_backup_never_exposes_secrets(tmp_path, monkeypatch):
+    env_file = tmp_path / '.env'
+    env_file.write_text("CLOUDFLARE_API_TOKEN=old\n", encoding='utf-8')
+    env_file.chmod(0o640)
+    backup_file = tmp_path / '.env.backup'
+    
+    if os.geteuid() == 0:
+        os.chown(env_file, 1234, 1234)
+    
+    # Права временного файла, когда токен в него уже записан
+    modes = []
+    real_fsync = os.fsync
+    
+    def fsync(fd):
+        modes.append(stat.S_IMODE(os.fstat(fd).st_mode))
+        real_fsync(fd)
+    
+    monkeypatch.setattr(os, 'fsync', fsync)
+    old_umask = os.umask(0)
+    try:
+        setup_caddy_ssl_workarounds.replace_with_backup(
+            env_file, backup_file, "CLOUDFLARE_API_TOKEN=new\n"
+        )
+    finally:
+        os.umask(old_umask)
+    
+    assert modes == [0o600]
+    st = os.stat(env_file)
+    assert stat.S_IMODE(st.st_mode) == 0o640
+    if os.geteuid() == 0:
+        assert (st.st_uid, st.st_gid) == (1234, 1234)
+    assert env_file.read_text(encoding='utf-8') == "CLOUDFLARE_API_TOKEN=new\n"
+    assert backup_file.read_text(encoding='utf-8') == "CLOUDFLARE_API_TOKEN=old\n"
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['.env', '.env.backup']
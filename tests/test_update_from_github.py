@@ -0,0 +1,164 @@
+"""
+Тесты update_from_github.py
+"""
+import http.server
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import update_from_github
+import installer.docker_manager as docker_manager
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason="права POSIX")
+def test_regeneration_keeps_env_mode(tmp_path, monkeypatch):
+    """После перегенерации .env сохраняет права 0600"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(docker_manager, 'docker_compose_down', lambda: True)
+    monkeypatch.setattr(docker_manager, 'docker_compose_up', lambda: True)
+    
+    env_file = tmp_path / ".env"
+    env_file.write_text("ROUTING_MODE=localhost\nPOSTGRES_PASSWORD=secret\n", encoding='utf-8')
+    env_file.chmod(0o600)
+    
+    env_config = update_from_github.load_env_config()
+    config = update_from_github.convert_env_to_config(env_config)
+    assert update_from_github.regenerate_and_restart(config, False, None, env_config)
+    
+    assert stat.S_IMODE(os.stat(env_file).st_mode) == 0o600
+    assert "POSTGRES_PASSWORD=secret" in env_file.read_text(encoding='utf-8')
+
+
+def _git(cwd, *args):
+    """Выполняет git в каталоге cwd и возвращает stdout"""
+    return subprocess.run(
+        ['git', *args], cwd=cwd, check=True, capture_output=True, text=True
+    ).stdout.strip()
+
+
+@pytest.fixture
+def shallow_clone(tmp_path, monkeypatch):
+    """Неполный клон (--depth=1) и рабочая копия для новых коммитов в origin"""
+    for name in ('GIT_AUTHOR_NAME', 'GIT_COMMITTER_NAME'):
+        monkeypatch.setenv(name, 'test')
+    for name in ('GIT_AUTHOR_EMAIL', 'GIT_COMMITTER_EMAIL'):
+        monkeypatch.setenv(name, 'test@example.com')
+    
+    origin = tmp_path / "origin.git"
+    upstream = tmp_path / "upstream"
+    clone = tmp_path / "clone"
+    _git(tmp_path, 'init', '-q', '--bare', '-b', 'main', str(origin))
+    _git(tmp_path, 'clone', '-q', str(origin), str(upstream))
+    _git(upstream, 'checkout', '-q', '-b', 'main')
+    for number in range(3):
+        (upstream / "file.txt").write_text(f"{number}\n", encoding='utf-8')
+        _git(upstream, 'add', 'file.txt')
+        _git(upstream, 'commit', '-q', '-m', f'c{number}')
+    _git(upstream, 'push', '-q', 'origin', 'main')
+    _git(tmp_path, 'clone', '-q', '--depth=1', '-b', 'main', f'file://{origin}', str(clone))
+    
+    # Новый коммит в origin, который должен прийти обновлением
+    (upstream / "file.txt").write_text("new\n", encoding='utf-8')
+    _git(upstream, 'commit', '-q', '-am', 'new')
+    _git(upstream, 'push', '-q', 'origin', 'main')
+    
+    monkeypatch.chdir(clone)
+    return clone, _git(upstream, 'rev-parse', 'HEAD')
+
+
+def test_shallow_update_fast_forwards(shallow_clone):
+    """Неполный клон без локальных коммитов переходит на новый коммит origin"""
+    clone, new_tip = shallow_clone
+    assert update_from_github.update_from_github()
+    assert _git(clone, 'rev-parse', 'HEAD') == new_tip
+    assert _git(clone, 'rev-parse', '--is-shallow-repository') == 'true'
+
+
+def test_shallow_update_keeps_local_commits(shallow_clone):
+    """Локальные коммиты в неполном клоне не теряются: обновление отказывает"""
+    clone, new_tip = shallow_clone
+    (clone / "local.txt").write_text("local\n", encoding='utf-8')
+    _git(clone, 'add', 'local.txt')
+    _git(clone, 'commit', '-q', '-m', 'local')
+    local_head = _git(clone, 'rev-parse', 'HEAD')
+    
+    assert not update_from_github.update_from_github()
+    assert _git(clone, 'rev-parse', 'HEAD') == local_head
+
+
+def test_fetch_without_credentials_fails_fast(tmp_path, monkeypatch, capsys):
+    class AuthRequired(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(401)
+            self.send_header('WWW-Authenticate', 'Basic realm="git"')
+            self.end_headers()
+        
+        def log_message(self, *args):
+            pass
+    
+    server = http.server.HTTPServer(('127.0.0.1', 0), AuthRequired)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        _git(tmp_path, 'init', '-q')
+        _git(tmp_path, 'remote', 'add', 'origin', f'http://127.0.0.1:{server.server_port}/repo.git')
+        monkeypatch.chdir(tmp_path)
+        
+        assert not update_from_github.fetch_updates('main', interactive=False)
+    finally:
+        server.shutdown()
+    
+    assert 'credential helper' in capsys.readouterr().out
+
+
+def test_env_cache_is_private(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / '.env').write_text("POSTGRES_PASSWORD=secret\n", encoding='utf-8')
+    cache_file = tmp_path / update_from_github._ENV_CACHE_FILE
+    cache_file.parent.mkdir()
+    cache_file.write_text('{}', encoding='utf-8')
+    cache_file.chmod(0o644)
+    old_umask = os.umask(0)
+    try:
+        config = update_from_github.load_env_config()
+    finally:
+        os.umask(old_umask)
+    
+    assert config == {'POSTGRES_PASSWORD': 'secret'}
+    assert stat.S_IMODE(os.stat(cache_file).st_mode) == 0o600
+    assert [p.name for p in cache_file.parent.iterdir()] == [cache_file.name]
+
+
+def test_idle_git_is_killed_even_if_helper_holds_output(tmp_path, monkeypatch):
+    # Команда алиаса "!" - дочерний процесс git, как ssh или git-remote-https:
+    # после завершения git она продолжает держать канал вывода открытым
+    monkeypatch.chdir(tmp_path)
+    started = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired):
+        update_from_github.run_git(
+            ['-c', 'alias.hang=!sleep 30', 'hang'], lambda line: None, idle_timeout=1
+        )
+    
+    assert time.monotonic() - started < 15
+
+
+def test_hardware_cache_refreshes_when_gpu_driver_appears(tmp_path, monkeypatch):
+    import installer.hardware_detector as hardware_detector
+    
+    monkeypatch.chdir(tmp_path)
+    calls = []
+    monkeypatch.setattr(hardware_detector, 'detect_hardware', lambda: calls.append(1) or {'gpu': {}})
+    monkeypatch.setattr(shutil, 'which', lambda name: None)
+    
+    update_from_github.cached_detect_hardware()
+    update_from_github.cached_detect_hardware()
+    assert len(calls) == 1
+    
+    monkeypatch.setattr(shutil, 'which', lambda name: f'/usr/bin/{name}')
+    update_from_github.cached_detect_hardware()
+    assert len(calls) == 2
@@ -2,15 +2,29 @@
 """
 Скрипт обновления системы и сервисов
 """
+import re
+import shutil
 import sys
 import subprocess
+import tempfile
 import datetime
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from rich.console import Console
 from rich.panel import Panel
 from rich.table import Table
 from rich.prompt import Confirm, Prompt
 from rich.progress import Progress, SpinnerColumn, TextColumn
+from rich.markup import escape
+import yaml
+
+try:
+    # LibYAML-парсер заметно быстрее чистого Python
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
 sys.path.insert(0, str(Path(__file__).parent))
 
@@ -23,6 +37,12 @@ from installer.utils import ensure_dir
 
 console = Console()
 
+# Строка "image: имя:тег" в docker-compose.yml
+_IMAGE_LINE_RE = re.compile(
+    r'^(?P<prefix>[ \t]*image:[ \t]*["\']?)(?P<image>[\w/.-]+):(?P<tag>[\w.-]+)',
+    re.MULTILINE
+)
+
 
 def show_welcome():
     """Приветственное сообщение"""
@@ -34,29 +54,113 @@ def show_welcome():
     console.print(Panel(welcome_text, title="Обновление системы", border_style="cyan"))
 
 
+def _backup_compressor():
+    """
+    Выбирает компрессор для бэкапа: (команда, расширение архива)
+    
+    zstd и pigz сжимают во все ядра, gzip — запасной вариант.
+    """
+    if shutil.which('zstd'):
+        return ['zstd', '-T0', '-q', '-c'], '.tar.zst'
+    if shutil.which('pigz'):
+        return ['pigz', '-c'], '.tar.gz'
+    return ['gzip', '-c'], '.tar.gz'
+
+
 def create_backup():
     """Создает бэкап volumes"""
     console.print("\n[cyan]💾 Создание бэкапа...[/cyan]")
     
     backup_dir = ensure_dir("backups")
     timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-    backup_name = f"backup_{timestamp}"
-    backup_path = backup_dir / backup_name
+    compress_cmd, suffix = _backup_compressor()
+    backup_path = backup_dir / f"backup_{timestamp}{suffix}"
     
+    tar = compressor = None
+    completed = False
     try:
-        # Создаем архив volumes
-        cmd = ['tar', '-czf', str(backup_path) + '.tar.gz', 'volumes/']
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
+        # Создаем архив volumes: tar | компрессор, без промежуточного .tar на диске.
+        # Сжатый поток пишем сами, попутно считая SHA-256, чтобы не перечитывать архив.
+        # stderr пишем во временные файлы, чтобы переполненный канал не остановил процессы
+        digest = hashlib.sha256()
+        with open(backup_path, 'wb') as archive, \
+                tempfile.TemporaryFile() as tar_err, tempfile.TemporaryFile() as compress_err:
+            tar = subprocess.Popen(['tar', '-cf', '-', 'volumes/'], stdout=subprocess.PIPE, stderr=tar_err)
+            compressor = subprocess.Popen(compress_cmd, stdin=tar.stdout, stdout=subprocess.PIPE, stderr=compress_err)
+            tar.stdout.close()
+            
+            def kill_pipeline():
+                tar.kill()
+                compressor.kill()
+            
+            timer = threading.Timer(300, kill_pipeline)
+            timer.start()
+            try:
+                while chunk := compressor.stdout.read(1 << 20):
+                    digest.update(chunk)
+                    archive.write(chunk)
+                compressor.stdout.close()
+                compressor.wait()
+                tar.wait()
+            finally:
+                timed_out = not timer.is_alive()
+                timer.cancel()
+            
+            tar_err.seek(0)
+            compress_err.seek(0)
+            errors = (tar_err.read() + compress_err.read()).decode(errors='replace')
+            if timed_out:
+                errors = f"таймаут (300 с) {errors}"
         
-        if result.returncode == 0:
-            console.print(f"[green]✓ Бэкап создан: {backup_path}.tar.gz[/green]")
+        if tar.returncode == 0 and compressor.returncode == 0:
+            # Контрольная сумма в формате sha256sum: проверка — sha256sum -c
+            checksum_path = backup_path.with_name(backup_path.name + '.sha256')
+            checksum_path.write_text(f"{digest.hexdigest()}  {backup_path.name}\n", encoding='utf-8')
+            completed = True
+            console.print(f"[green]✓ Бэкап создан: {backup_path}[/green]")
+            console.print(f"[dim]  SHA-256: {checksum_path}[/dim]")
             return True
         else:
-            console.print(f"[yellow]⚠ Не удалось создать бэкап: {result.stderr}[/yellow]")
+            console.print(f"[yellow]⚠ Не удалось создать бэкап: {errors}[/yellow]")
             return False
     except Exception as e:
         console.print(f"[yellow]⚠ Ошибка при создании бэкапа: {e}[/yellow]")
         return False
+    finally:
+        # При ошибке записи, сбое запуска компрессора или Ctrl+C процессы
+        # конвейера еще работают: завершаем и дожидаемся их, чтобы не оставить
+        # зомби и tar, читающий volumes. Недописанный архив удаляем
+        for process in (compressor, tar):
+            if process is None:
+                continue
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            if process.stdout and not process.stdout.closed:
+                process.stdout.close()
+        if not completed:
+            backup_path.unlink(missing_ok=True)
+
+
+def check_updates_parallel(current_versions: dict) -> dict:
+    """
+    Проверяет обновления для каждого сервиса в отдельном потоке
+    
+    Проверка одного сервиса может ждать ответа реестра, поэтому запросы
+    выполняются одновременно. Порядок сервисов сохраняется.
+    """
+    if not current_versions:
+        return {}
+    
+    def check_one(item):
+        service, version = item
+        return check_updates({service: version})
+    
+    updates = {}
+    with ThreadPoolExecutor(max_workers=min(8, len(current_versions))) as executor:
+        for result in executor.map(check_one, current_versions.items()):
+            updates.update(result)
+    return updates
 
 
 def show_updates_table(updates: dict):
@@ -116,23 +220,36 @@ def update_docker_compose(selected_updates: dict):
         return False
     
     try:
-        content = compose_file.read_text(encoding='utf-8')
+        content = compose_file.read_bytes().decode('utf-8')
         
-        # Обновляем версии образов
-        for service, info in selected_updates.items():
-            image_name = info['image']
-            old_version = info['current']
-            new_version = info['latest']
-            
-            # Заменяем версию в образе
-            old_image = f"{image_name}:{old_version}"
-            new_image = f"{image_name}:{new_version}"
-            content = content.replace(old_image, new_image)
-            
-            # Также заменяем если версия указана отдельно
-            content = content.replace(f"{service}:{old_version}", f"{service}:{new_version}")
+        # Новые теги по (образ, текущий тег)
+        new_tags = {
+            (info['image'], info['current']): info['latest']
+            for info in selected_updates.values()
+        }
+        
+        def replace_tag(match):
+            image = match.group('image')
+            tag = match.group('tag')
+            # Образ может быть указан с реестром: docker.io/n8nio/n8n
+            for name in (image, image.partition('/')[2]):
+                new_tag = new_tags.get((name, tag))
+                if new_tag:
+                    return f"{match.group('prefix')}{image}:{new_tag}"
+            return match.group(0)
         
-        compose_file.write_text(content, encoding='utf-8')
+        # Обновляем версии образов за один проход по строкам image:
+        content = _IMAGE_LINE_RE.sub(replace_tag, content)
+        
+        # Файл правится как текст (чтобы сохранить комментарии),
+        # поэтому перед записью проверяем результат YAML-парсером
+        try:
+            yaml.load(content, Loader=YamlLoader)
+        except yaml.YAMLError as e:
+            console.print(f"[red]❌ Ошибка синтаксиса docker-compose.yml после изменений: {e}[/red]")
+            return False
+        
+        compose_file.write_bytes(content.encode('utf-8'))
         console.print("[green]✓ docker-compose.yml обновлен[/green]")
         return True
     except Exception as e:
@@ -168,7 +285,12 @@ def update_services(selected_updates: dict):
         console=console
     ) as progress:
         task = progress.add_task("Загрузка образов...", total=None)
-        if docker_compose_pull():
+        
+        # Показываем строки вывода pull по мере загрузки образов
+        def show_pull_output(line):
+            progress.update(task, description=f"Загрузка образов: {escape(line)}")
+        
+        if docker_compose_pull(on_output=show_pull_output):
             progress.update(task, completed=True)
             console.print("[green]✓ Образы обновлены[/green]")
         else:
@@ -207,7 +329,7 @@ def main():
             console=console
         ) as progress:
             task = progress.add_task("Проверка версий...", total=None)
-            updates = check_updates(current_versions)
+            updates = check_updates_parallel(current_versions)
             progress.update(task, completed=True)
         
         # Показываем таблицу обновлений
@@ -2,23 +2,54 @@
 """
 Скрипт обновления проекта с GitHub с сохранением настроек
 """
+import argparse
+import hashlib
+import io
+import json
+import platform
+import os
+import re
 import sys
 import subprocess
 import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from rich.console import Console
 from rich.panel import Panel
 from rich.prompt import Confirm
 from rich.progress import Progress, SpinnerColumn, TextColumn
+from rich.markup import escape
 
 sys.path.insert(0, str(Path(__file__).parent))
 
-from installer.docker_manager import (
-    docker_compose_down, docker_compose_up, get_docker_compose_command
+console = Console()
+
+# Окружение для команд git, которые только читают репозиторий: без
+# необязательных блокировок status не обновляет индекс и не ждет другой git
+_GIT_READ_ENV = {**os.environ, 'GIT_OPTIONAL_LOCKS': '0', 'GIT_TERMINAL_PROMPT': '0'}
+
+# Окружение для git в run_git без пользователя за терминалом: вместо запроса
+# пароля (который повис бы до срабатывания сторожа) - сразу ошибка.
+# Собственная команда SSH пользователя сохраняется
+_GIT_BATCH_ENV = {**os.environ, 'GIT_TERMINAL_PROMPT': '0'}
+if 'GIT_SSH_COMMAND' not in os.environ and 'GIT_SSH' not in os.environ:
+    _GIT_BATCH_ENV['GIT_SSH_COMMAND'] = 'ssh -o BatchMode=yes'
+
+# Сообщения git о том, что для доступа к origin нужны учетные данные
+_GIT_AUTH_ERRORS = (
+    'terminal prompts disabled',
+    'could not read username',
+    'could not read password',
+    'authentication failed',
+    'permission denied (publickey',
+    'host key verification failed',
 )
-from installer.utils import ensure_dir
 
-console = Console()
+# Строка KEY=VALUE в .env; пустые строки и комментарии "#" не совпадают
+_ENV_LINE_RE = re.compile(rb'(?m)^[ \t]*([^#\s=][^=\n]*?)[ \t]*=([^\n]*)')
 
 
 def show_welcome():
@@ -27,7 +58,7 @@ def show_welcome():
 🔄 Обновление проекта с GitHub
 
 Этот скрипт:
-1. Обновит код с GitHub (git pull)
+1. Обновит код с GitHub (git fetch + fast-forward)
 2. Сохранит ваши настройки (.env)
 3. Перегенерирует конфигурационные файлы
 4. Перезапустит сервисы с новой конфигурацией
@@ -37,68 +68,273 @@ def show_welcome():
     console.print(Panel(welcome_text, title="Обновление с GitHub", border_style="cyan"))
 
 
-def check_git_repo():
-    """Проверяет что это git репозиторий"""
+def git_probe():
+    """
+    Проверяет репозиторий и получает текущую ветку одним вызовом git
+    
+    rev-parse печатает ответ на каждый аргумент отдельной строкой:
+    "true" для --is-inside-work-tree и --is-shallow-repository и имя ветки
+    для --abbrev-ref HEAD. Возвращает (это репозиторий, ветка или None,
+    неполный клон).
+    """
     try:
         result = subprocess.run(
-            ['git', 'rev-parse', '--git-dir'],
+            ['git', 'rev-parse', '--is-inside-work-tree', '--is-shallow-repository',
+             '--abbrev-ref', 'HEAD'],
             capture_output=True,
+            env=_GIT_READ_ENV,
             text=True,
             timeout=5
         )
-        return result.returncode == 0
     except Exception:
-        return False
+        return False, None, False
+    
+    lines = result.stdout.splitlines()
+    # В репозитории без коммитов HEAD не разрешается, но первые строки уже выведены
+    is_repo = bool(lines) and lines[0] == 'true'
+    shallow = len(lines) > 1 and lines[1] == 'true'
+    branch = lines[2] if result.returncode == 0 and len(lines) > 2 else None
+    return is_repo, branch, shallow
+
+
+def get_changed_files():
+    """Возвращает список измененных файлов из git status --porcelain -z"""
+    result = subprocess.run(
+        ['git', 'status', '--porcelain', '-z'],
+        capture_output=True,
+        env=_GIT_READ_ENV,
+        text=True,
+        timeout=5
+    )
+    changed_files = []
+    entries = iter(result.stdout.split('\0'))
+    for entry in entries:
+        if len(entry) < 4:
+            continue
+        changed_files.append(entry[3:])
+        # Для переименования/копирования следом идет исходный путь
+        if entry[0] in 'RC':
+            next(entries, None)
+    return changed_files
 
 
-def get_current_branch():
-    """Получает текущую ветку"""
+def run_git(args, on_output, idle_timeout=60, interactive=True):
+    """
+    Выполняет команду git, передавая строки вывода в on_output по мере появления
+    
+    stderr объединен с stdout, чтобы сообщения git шли в исходном порядке.
+    Строки прогресса git разделяет "\r": они передаются в on_output, но
+    в итоговый вывод попадают только завершенные "\n" строки.
+    Возвращает (код возврата, вывод). Ограничено время тишины, а не всей
+    команды: медленная, но идущая загрузка не прерывается, а если вывода нет
+    дольше idle_timeout секунд, процесс завершается и поднимается TimeoutExpired.
+    
+    git остается в терминале пользователя и может спросить логин, пароль или
+    парольную фразу SSH. С interactive=False запросы отключены, и без
+    сохраненных учетных данных или ssh-agent команда сразу завершается с ошибкой.
+    """
+    cmd = ['git', *args]
+    process = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        env=None if interactive else _GIT_BATCH_ENV
+    )
+    stream = io.TextIOWrapper(process.stdout, encoding='utf-8', errors='replace', newline='')
+    last_output = [time.monotonic()]
+    lines = []
+    
+    def read_output():
+        for line in stream:
+            last_output[0] = time.monotonic()
+            if line.endswith('\n'):
+                lines.append(line)
+            line = line.strip()
+            if line:
+                on_output(line)
+    
+    # Вывод читается в отдельном потоке: помощники git (ssh, git-remote-https)
+    # наследуют канал и могут держать его открытым после завершения git,
+    # поэтому конец команды определяется по самому git, а не по концу вывода
+    reader = threading.Thread(target=read_output, daemon=True)
+    reader.start()
+    timed_out = False
+    try:
+        while True:
+            try:
+                returncode = process.wait(timeout=1)
+                break
+            except subprocess.TimeoutExpired:
+                if time.monotonic() - last_output[0] > idle_timeout:
+                    timed_out = True
+                    process.kill()
+    finally:
+        # Например, при Ctrl+C, если git сам не завершился
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+    
+    reader.join(5)
+    if not reader.is_alive():
+        stream.close()
+    
+    if timed_out:
+        raise subprocess.TimeoutExpired(cmd, idle_timeout)
+    return returncode, ''.join(lines)
+
+
+def count_new_commits():
+    """Количество коммитов в FETCH_HEAD, которых нет в HEAD (None при ошибке)"""
     try:
         result = subprocess.run(
-            ['git', 'rev-parse', '--abbrev-ref', 'HEAD'],
+            ['git', 'rev-list', '--count', 'HEAD..FETCH_HEAD'],
             capture_output=True,
+            env=_GIT_READ_ENV,
             text=True,
-            timeout=5
+            timeout=10
         )
         if result.returncode == 0:
-            return result.stdout.strip()
+            return int(result.stdout.strip())
+    except (subprocess.SubprocessError, OSError, ValueError):
+        pass
+    return None
+
+
+def get_remote_tip(branch):
+    """Коммит refs/remotes/origin/<branch> или None, если ссылки нет"""
+    try:
+        result = subprocess.run(
+            ['git', 'rev-parse', '--verify', '--quiet', f'refs/remotes/origin/{branch}'],
+            capture_output=True,
+            env=_GIT_READ_ENV,
+            text=True,
+            timeout=5
+        )
+    except (subprocess.SubprocessError, OSError):
         return None
-    except Exception:
+    return result.stdout.strip() if result.returncode == 0 else None
+
+
+def get_local_commits(base):
+    """Коммиты HEAD, недостижимые из base (None при ошибке)"""
+    try:
+        result = subprocess.run(
+            ['git', 'rev-list', f'{base}..HEAD'],
+            capture_output=True,
+            env=_GIT_READ_ENV,
+            text=True,
+            timeout=10
+        )
+    except (subprocess.SubprocessError, OSError):
+        return None
+    if result.returncode != 0:
         return None
+    return result.stdout.split()
+
+
+def fetch_updates(branch, shallow=False, interactive=True):
+    """
+    Загружает изменения ветки из origin в FETCH_HEAD, не трогая рабочую копию
+    
+    Для неполного клона загружается только последний коммит (--depth=1),
+    чтобы история в .git не накапливалась от обновления к обновлению.
+    С interactive=False git не спрашивает логин и пароль (см. run_git).
+    """
+    # --progress: без терминала git молчит во время загрузки, а вывод нужен
+    # спиннеру и сторожу тишины в run_git
+    args = ['fetch', '--progress', 'origin', branch]
+    if shallow:
+        args.insert(2, '--depth=1')
+    try:
+        # Спиннер перерисовывается только по выводу git, иначе он затер бы
+        # запрос пароля, который git печатает прямо в терминал
+        with Progress(
+            SpinnerColumn(),
+            TextColumn("[progress.description]{task.description}"),
+            console=console,
+            auto_refresh=not interactive
+        ) as progress:
+            task = progress.add_task("Загрузка обновлений...", total=None)
+            
+            returncode, output = run_git(
+                args,
+                lambda line: progress.update(task, description=escape(line[:80]), refresh=True),
+                interactive=interactive
+            )
+            
+            progress.update(task, completed=True)
+    except subprocess.TimeoutExpired:
+        console.print("[red]❌ Таймаут при загрузке обновлений[/red]")
+        return False
+    except Exception as e:
+        console.print(f"[red]❌ Ошибка: {e}[/red]")
+        return False
+    
+    if returncode != 0:
+        console.print(f"[red]❌ Ошибка при загрузке обновлений: {escape(output)}[/red]")
+        if not interactive and any(marker in output.lower() for marker in _GIT_AUTH_ERRORS):
+            console.print("[cyan]💡 origin требует авторизации, а запрос пароля отключен (--non-interactive или нет терминала).[/cyan]")
+            console.print("   Настройте credential helper или ssh-agent либо выполните вручную:")
+            console.print(f"   git fetch origin {branch}")
+        return False
+    return True
 
 
-def update_from_github():
-    """Обновляет код с GitHub"""
+def update_from_github(interactive=True):
+    """Обновляет код с GitHub (interactive=False - без запросов пароля от git)"""
     console.print("\n[cyan]📥 Обновление кода с GitHub...[/cyan]")
     
+    is_repo, current_branch, shallow = git_probe()
+    
     # Проверяем что это git репозиторий
-    if not check_git_repo():
+    if not is_repo:
         console.print("[red]❌ Это не git репозиторий![/red]")
         console.print("   Клонируйте проект: git clone https://github.com/SerKit163/n8n_langflow_supabase_in_docker.git")
         return False
     
-    # Получаем текущую ветку
-    current_branch = get_current_branch()
+    # Текущая ветка
     if not current_branch:
         console.print("[yellow]⚠ Не удалось определить текущую ветку[/yellow]")
         current_branch = "main"
     
     console.print(f"[cyan]Текущая ветка: {current_branch}[/cyan]")
     
+    # В неполном клоне запоминаем, где была ветка origin до загрузки:
+    # после fetch --depth=1 это единственная опора для поиска локальных коммитов
+    origin_before = get_remote_tip(current_branch) if shallow else None
+    
+    # Сначала только загружаем изменения: если новых коммитов нет,
+    # рабочую копию и незакоммиченные изменения трогать не нужно
+    if not fetch_updates(current_branch, shallow, interactive):
+        return False
+    
+    new_commits = count_new_commits()
+    if new_commits == 0:
+        console.print("[green]✓ Код уже актуален, новых коммитов нет[/green]")
+        return True
+    if new_commits:
+        console.print(f"[cyan]Новых коммитов: {new_commits}[/cyan]")
+    
+    # reset --keep перенес бы ветку на FETCH_HEAD и потерял бы коммиты,
+    # которых нет в origin, поэтому при их наличии обновление не выполняется
+    if shallow:
+        local = get_local_commits(origin_before or 'FETCH_HEAD')
+        if local is None or local:
+            console.print("[red]❌ В неполном клоне есть локальные коммиты, которых нет в origin[/red]")
+            if local:
+                console.print(f"[cyan]Локальных коммитов: {len(local)}[/cyan]")
+            console.print("   Обновление через reset потеряло бы их. Сохраните коммиты или выполните:")
+            console.print(f"   git fetch --unshallow origin && git pull origin {current_branch}")
+            return False
+    
     # Проверяем есть ли изменения
     has_changes = False
     changed_files = []
     choice = None
     try:
-        result = subprocess.run(
-            ['git', 'status', '--porcelain'],
-            capture_output=True,
-            text=True,
-            timeout=5
-        )
-        if result.stdout.strip():
+        changed_files = get_changed_files()
+        if changed_files:
             has_changes = True
-            changed_files = [line.split()[1] for line in result.stdout.strip().split('\n') if line.strip()]
             console.print("[yellow]⚠ У вас есть незакоммиченные изменения![/yellow]")
             console.print(f"[cyan]Измененные файлы: {', '.join(changed_files[:5])}[/cyan]")
             if len(changed_files) > 5:
@@ -149,55 +385,54 @@ def update_from_github():
     except Exception as e:
         console.print(f"[yellow]⚠ Не удалось проверить статус: {e}[/yellow]")
     
-    # Выполняем git pull
+    # Применяем загруженные изменения: только fast-forward. После --depth=1
+    # общей истории с HEAD нет, поэтому неполный клон без локальных коммитов
+    # (проверено выше) переводится на FETCH_HEAD через reset --keep
+    # (незакоммиченные изменения сохраняются)
+    if shallow:
+        apply_cmd = ['git', 'reset', '--keep', 'FETCH_HEAD']
+    else:
+        apply_cmd = ['git', 'merge', '--ff-only', 'FETCH_HEAD']
     try:
-        with Progress(
-            SpinnerColumn(),
-            TextColumn("[progress.description]{task.description}"),
-            console=console
-        ) as progress:
-            task = progress.add_task("Загрузка обновлений...", total=None)
-            
-            result = subprocess.run(
-                ['git', 'pull', 'origin', current_branch],
-                capture_output=True,
-                text=True,
-                timeout=60
-            )
+        result = subprocess.run(
+            apply_cmd,
+            capture_output=True,
+            text=True,
+            timeout=60
+        )
+        
+        if result.returncode == 0:
+            console.print("[green]✓ Код успешно обновлен с GitHub[/green]")
+            if result.stdout.strip():
+                console.print(escape(result.stdout))
             
-            progress.update(task, completed=True)
+            # Если были изменения в stash, предлагаем восстановить
+            if has_changes and choice == "1":
+                console.print("\n[cyan]💡 У вас были сохранены изменения в stash[/cyan]")
+                if Confirm.ask("Восстановить изменения из stash?", default=True):
+                    stash_pop = subprocess.run(
+                        ['git', 'stash', 'pop'],
+                        capture_output=True,
+                        text=True,
+                        timeout=10
+                    )
+                    if stash_pop.returncode == 0:
+                        console.print("[green]✓ Изменения восстановлены из stash[/green]")
+                    else:
+                        console.print("[yellow]⚠ Не удалось восстановить из stash (возможны конфликты)[/yellow]")
+                        console.print("[cyan]💡 Восстановите вручную: git stash pop[/cyan]")
+                        if stash_pop.stderr:
+                            console.print(f"[dim]{escape(stash_pop.stderr)}[/dim]")
             
-            if result.returncode == 0:
-                console.print("[green]✓ Код успешно обновлен с GitHub[/green]")
-                if result.stdout.strip():
-                    console.print(result.stdout)
-                
-                # Если были изменения в stash, предлагаем восстановить
-                if has_changes and choice == "1":
-                    console.print("\n[cyan]💡 У вас были сохранены изменения в stash[/cyan]")
-                    if Confirm.ask("Восстановить изменения из stash?", default=True):
-                        stash_pop = subprocess.run(
-                            ['git', 'stash', 'pop'],
-                            capture_output=True,
-                            text=True,
-                            timeout=10
-                        )
-                        if stash_pop.returncode == 0:
-                            console.print("[green]✓ Изменения восстановлены из stash[/green]")
-                        else:
-                            console.print("[yellow]⚠ Не удалось восстановить из stash (возможны конфликты)[/yellow]")
-                            console.print("[cyan]💡 Восстановите вручную: git stash pop[/cyan]")
-                            if stash_pop.stderr:
-                                console.print(f"[dim]{stash_pop.stderr}[/dim]")
-                
-                return True
-            else:
-                console.print(f"[red]❌ Ошибка при обновлении: {result.stderr}[/red]")
-                # Если был stash, предупреждаем
-                if has_changes and choice == "1":
-                    console.print("[yellow]⚠ Изменения сохранены в stash, но обновление не удалось[/yellow]")
-                    console.print("[cyan]💡 Восстановите: git stash pop[/cyan]")
-                return False
+            return True
+        else:
+            console.print(f"[red]❌ Ошибка при обновлении: {escape(result.stderr)}[/red]")
+            console.print(f"[cyan]💡 Если ветка разошлась с origin, объедините вручную: git pull origin {current_branch}[/cyan]")
+            # Если был stash, предупреждаем
+            if has_changes and choice == "1":
+                console.print("[yellow]⚠ Изменения сохранены в stash, но обновление не удалось[/yellow]")
+                console.print("[cyan]💡 Восстановите: git stash pop[/cyan]")
+            return False
     except subprocess.TimeoutExpired:
         console.print("[red]❌ Таймаут при обновлении[/red]")
         return False
@@ -206,6 +441,27 @@ def update_from_github():
         return False
 
 
+def _copy_file(src, dst):
+    """
+    Копирует файл с метаданными через copy_file_range
+    
+    На одной файловой системе ядро копирует данные само, а на btrfs/xfs
+    может просто сослаться на те же блоки. Если системный вызов недоступен,
+    используется shutil.copyfile.
+    """
+    try:
+        with open(src, 'rb') as source, open(dst, 'wb') as target:
+            remaining = os.fstat(source.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(source.fileno(), target.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+    except (AttributeError, OSError):
+        shutil.copyfile(src, dst)
+    shutil.copystat(src, dst)
+
+
 def backup_env():
     """Создает резервную копию .env"""
     env_file = Path(".env")
@@ -213,11 +469,20 @@ def backup_env():
         console.print("[yellow]⚠ Файл .env не найден[/yellow]")
         return None
     
+    from installer.utils import ensure_dir
+    
     backup_dir = ensure_dir("backups")
     backup_file = backup_dir / ".env.backup"
     
     try:
-        shutil.copy2(env_file, backup_file)
+        # Если .env не менялся с прошлой копии, не переписываем ее
+        if (backup_file.exists()
+                and backup_file.stat().st_size == env_file.stat().st_size
+                and backup_file.read_bytes() == env_file.read_bytes()):
+            console.print(f"[green]✓ Резервная копия .env актуальна: {backup_file}[/green]")
+            return backup_file
+        
+        _copy_file(env_file, backup_file)
         console.print(f"[green]✓ Резервная копия .env создана: {backup_file}[/green]")
         return backup_file
     except Exception as e:
@@ -225,8 +490,21 @@ def backup_env():
         return None
 
 
+def _unquote(value):
+    """Убирает парные кавычки вокруг значения, если они есть"""
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in '"\'':
+        return value[1:-1]
+    return value
+
+
+# Разобранный .env с прошлого запуска
+_ENV_CACHE_FILE = Path("backups") / ".env.cache.json"
+
+
 def load_env_config():
     """Загружает конфигурацию из существующего .env файла"""
+    from installer.utils import write_file_atomic
+    
     env_file = Path(".env")
     if not env_file.exists():
         console.print("[yellow]⚠ Файл .env не найден[/yellow]")
@@ -235,28 +513,34 @@ def load_env_config():
     
     console.print("\n[cyan]📖 Чтение текущей конфигурации из .env...[/cyan]")
     
-    config = {}
     try:
-        content = env_file.read_text(encoding='utf-8')
+        # Разобранный .env кэшируется; время изменения и размер файла
+        # служат дешевым признаком того, что он не менялся
+        st = env_file.stat()
+        stamp = [st.st_mtime_ns, st.st_size]
+        try:
+            cached = json.loads(_ENV_CACHE_FILE.read_bytes())
+            if cached.get('stamp') == stamp:
+                config = cached['config']
+                console.print(f"[green]✓ Загружено {len(config)} переменных из .env[/green]")
+                return config
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
         
-        # Парсим переменные из .env
-        for line in content.split('\n'):
-            line = line.strip()
-            if not line or line.startswith('#'):
-                continue
-            
-            if '=' in line:
-                key, value = line.split('=', 1)
-                key = key.strip()
-                value = value.strip()
-                
-                # Убираем кавычки если есть
-                if value.startswith('"') and value.endswith('"'):
-                    value = value[1:-1]
-                elif value.startswith("'") and value.endswith("'"):
-                    value = value[1:-1]
-                
-                config[key] = value
+        content = env_file.read_bytes()
+        
+        # Парсим переменные из .env одним проходом регулярного выражения
+        # по байтам; в строки декодируются только найденные ключи и значения
+        config = {
+            match.group(1).decode('utf-8'): _unquote(match.group(2).strip().decode('utf-8'))
+            for match in _ENV_LINE_RE.finditer(content)
+        }
+        
+        # В кэше те же пароли, что и в .env
+        try:
+            write_file_atomic(_ENV_CACHE_FILE, json.dumps({'stamp': stamp, 'config': config}))
+        except OSError:
+            pass
         
         console.print(f"[green]✓ Загружено {len(config)} переменных из .env[/green]")
         return config
@@ -265,50 +549,30 @@ def load_env_config():
         return None
 
 
+# Настройки сервисов в .env: (имя, порт, лимит памяти, лимит CPU) по умолчанию.
+# Для имени n8n читаются N8N_DOMAIN, N8N_PATH, N8N_PORT, N8N_MEMORY_LIMIT, N8N_CPU_LIMIT
+_SERVICES = (
+    ('n8n', 5678, '2g', 0.5),
+    ('langflow', 7860, '4g', 0.5),
+    ('supabase', 8000, '1g', 0.3),
+    ('ollama', 11434, '2g', 1.0),
+)
+
+
 def convert_env_to_config(env_config):
     """Конвертирует переменные .env в формат конфигурации для setup.py"""
     if not env_config:
         return None
     
-    config = {}
+    get = env_config.get
     
-    # Роутинг
-    config['routing_mode'] = env_config.get('ROUTING_MODE', '')
-    
-    # Домены
-    config['n8n_domain'] = env_config.get('N8N_DOMAIN', '')
-    config['langflow_domain'] = env_config.get('LANGFLOW_DOMAIN', '')
-    config['supabase_domain'] = env_config.get('SUPABASE_DOMAIN', '')
-    config['ollama_domain'] = env_config.get('OLLAMA_DOMAIN', '')
-    config['base_domain'] = env_config.get('BASE_DOMAIN', '')
-    
-    # Пути
-    config['n8n_path'] = env_config.get('N8N_PATH', '/n8n')
-    config['langflow_path'] = env_config.get('LANGFLOW_PATH', '/langflow')
-    config['supabase_path'] = env_config.get('SUPABASE_PATH', '/supabase')
-    config['ollama_path'] = env_config.get('OLLAMA_PATH', '/ollama')
-    
-    # Email для SSL
-    config['letsencrypt_email'] = env_config.get('LETSENCRYPT_EMAIL', '')
-    
-    # Сервисы - проверяем какие включены (по умолчанию все включены для обратной совместимости)
-    n8n_enabled_str = env_config.get('N8N_ENABLED', 'true').strip().lower()
-    config['n8n_enabled'] = n8n_enabled_str != 'false'
-    
-    langflow_enabled_str = env_config.get('LANGFLOW_ENABLED', 'true').strip().lower()
-    config['langflow_enabled'] = langflow_enabled_str != 'false'
-    
-    # Supabase всегда включен
-    config['supabase_enabled'] = True
-    
-    # Ollama - только если явно включен в .env
-    ollama_enabled_str = env_config.get('OLLAMA_ENABLED', '').strip().lower()
-    config['ollama_enabled'] = ollama_enabled_str == 'true'
-    
-    # Порты - только для включенных сервисов, безопасное преобразование
     def safe_int(value, default):
         """Безопасно преобразует значение в int, возвращает default если пустое"""
-        if not value or value.strip() == '':
+        value = value.strip() if value else ''
+        # Обычный случай - порт из одних цифр, исключение не нужно
+        if value.isdecimal():
+            return int(value)
+        if not value:
             return default
         try:
             return int(value)
@@ -317,101 +581,158 @@ def convert_env_to_config(env_config):
     
     def safe_float(value, default):
         """Безопасно преобразует значение в float, возвращает default если пустое"""
-        if not value or value.strip() == '':
+        value = value.strip() if value else ''
+        # Обычный случай - число вида 0.5 или 2
+        if value.replace('.', '', 1).isdecimal():
+            return float(value)
+        if not value:
             return default
         try:
             return float(value)
         except (ValueError, TypeError):
             return default
     
-    # Порты - только для включенных сервисов
-    if config['n8n_enabled']:
-        config['n8n_port'] = safe_int(env_config.get('N8N_PORT', ''), 5678)
-    if config['langflow_enabled']:
-        config['langflow_port'] = safe_int(env_config.get('LANGFLOW_PORT', ''), 7860)
-    # Supabase всегда включен
-    config['supabase_port'] = safe_int(env_config.get('SUPABASE_PORT', ''), 8000)
-    config['supabase_kb_port'] = safe_int(env_config.get('SUPABASE_KB_PORT', ''), 3000)
-    if config['ollama_enabled']:
-        config['ollama_port'] = safe_int(env_config.get('OLLAMA_PORT', ''), 11434)
-    
-    # Лимиты ресурсов - только для включенных сервисов
-    if config['n8n_enabled']:
-        config['n8n_memory_limit'] = env_config.get('N8N_MEMORY_LIMIT', '2g') or '2g'
-        config['n8n_cpu_limit'] = safe_float(env_config.get('N8N_CPU_LIMIT', ''), 0.5)
-    if config['langflow_enabled']:
-        config['langflow_memory_limit'] = env_config.get('LANGFLOW_MEMORY_LIMIT', '4g') or '4g'
-        config['langflow_cpu_limit'] = safe_float(env_config.get('LANGFLOW_CPU_LIMIT', ''), 0.5)
-    # Supabase всегда включен
-    config['supabase_memory_limit'] = env_config.get('SUPABASE_MEMORY_LIMIT', '1g') or '1g'
-    config['supabase_cpu_limit'] = safe_float(env_config.get('SUPABASE_CPU_LIMIT', ''), 0.3)
-    if config['ollama_enabled']:
-        config['ollama_memory_limit'] = env_config.get('OLLAMA_MEMORY_LIMIT', '2g') or '2g'
-        config['ollama_cpu_limit'] = safe_float(env_config.get('OLLAMA_CPU_LIMIT', ''), 1.0)
+    config = {
+        'routing_mode': get('ROUTING_MODE', ''),
+        'base_domain': get('BASE_DOMAIN', ''),
+        # Email для SSL
+        'letsencrypt_email': get('LETSENCRYPT_EMAIL', ''),
+        # Сервисы - по умолчанию n8n и Langflow включены для обратной совместимости,
+        # Supabase включен всегда, Ollama - только если явно включен в .env
+        'n8n_enabled': get('N8N_ENABLED', 'true').strip().lower() != 'false',
+        'langflow_enabled': get('LANGFLOW_ENABLED', 'true').strip().lower() != 'false',
+        'supabase_enabled': True,
+        'ollama_enabled': get('OLLAMA_ENABLED', '').strip().lower() == 'true',
+    }
+    
+    # Домен, путь, порт и лимиты ресурсов - только для включенных сервисов,
+    # чтобы настройки выключенных не попали в конфигурацию
+    for name, port, memory_limit, cpu_limit in _SERVICES:
+        if not config[f'{name}_enabled']:
+            continue
+        prefix = name.upper()
+        config[f'{name}_domain'] = get(f'{prefix}_DOMAIN', '')
+        config[f'{name}_path'] = get(f'{prefix}_PATH', f'/{name}')
+        config[f'{name}_port'] = safe_int(get(f'{prefix}_PORT', ''), port)
+        config[f'{name}_memory_limit'] = get(f'{prefix}_MEMORY_LIMIT', memory_limit) or memory_limit
+        config[f'{name}_cpu_limit'] = safe_float(get(f'{prefix}_CPU_LIMIT', ''), cpu_limit)
     
     # Supabase
-    config['postgres_password'] = env_config.get('POSTGRES_PASSWORD', '')
-    config['supabase_admin_login'] = env_config.get('SUPABASE_ADMIN_LOGIN', 'admin')
-    config['supabase_admin_password'] = env_config.get('SUPABASE_ADMIN_PASSWORD', '')
-    config['supabase_admin_password_hash'] = env_config.get('SUPABASE_ADMIN_PASSWORD_HASH', '')
-    config['jwt_secret'] = env_config.get('JWT_SECRET', '')
-    config['anon_key'] = env_config.get('ANON_KEY', '')
-    config['service_role_key'] = env_config.get('SERVICE_ROLE_KEY', '')
-    
-    # Если сервисы не включены, не добавляем их настройки
-    if not config['n8n_enabled']:
-        config.pop('n8n_domain', None)
-        config.pop('n8n_path', None)
-        config.pop('n8n_port', None)
-        config.pop('n8n_memory_limit', None)
-        config.pop('n8n_cpu_limit', None)
-    
-    if not config['langflow_enabled']:
-        config.pop('langflow_domain', None)
-        config.pop('langflow_path', None)
-        config.pop('langflow_port', None)
-        config.pop('langflow_memory_limit', None)
-        config.pop('langflow_cpu_limit', None)
-    
-    if not config['ollama_enabled']:
-        # Очищаем настройки Ollama, чтобы они не попали в конфигурацию
-        config.pop('ollama_domain', None)
-        config.pop('ollama_path', None)
-        config.pop('ollama_port', None)
-        config.pop('ollama_memory_limit', None)
-        config.pop('ollama_cpu_limit', None)
+    config['supabase_kb_port'] = safe_int(get('SUPABASE_KB_PORT', ''), 3000)
+    config['postgres_password'] = get('POSTGRES_PASSWORD', '')
+    config['supabase_admin_login'] = get('SUPABASE_ADMIN_LOGIN', 'admin')
+    config['supabase_admin_password'] = get('SUPABASE_ADMIN_PASSWORD', '')
+    config['supabase_admin_password_hash'] = get('SUPABASE_ADMIN_PASSWORD_HASH', '')
+    config['jwt_secret'] = get('JWT_SECRET', '')
+    config['anon_key'] = get('ANON_KEY', '')
+    config['service_role_key'] = get('SERVICE_ROLE_KEY', '')
     
     return config
 
 
-def regenerate_configs(config):
-    """Перегенерирует конфигурационные файлы"""
+def _hardware_fingerprint():
+    """
+    Дешевый отпечаток машины: имя хоста, архитектура, число CPU, объем RAM
+    и признаки NVIDIA GPU
+    
+    От наличия GPU зависит шаблон docker-compose, поэтому установка или
+    удаление карты либо драйвера должны сбрасывать кэш. nvidia-smi в PATH
+    и устройства /dev/nvidiaN проверяются без запуска самого nvidia-smi.
+    """
+    import psutil
+    nvidia_devices = sorted(
+        path.name for path in Path('/dev').glob('nvidia[0-9]*')
+    ) if os.name == 'posix' else []
+    return [
+        platform.node(),
+        platform.machine(),
+        psutil.cpu_count(logical=True),
+        psutil.virtual_memory().total,
+        shutil.which('nvidia-smi') is not None,
+        nvidia_devices,
+    ]
+
+
+def cached_detect_hardware(refresh=False):
+    """
+    Определяет железо, используя результат прошлого запуска
+    
+    Полная проверка опрашивает nvidia-smi/rocm-smi и т.п., а между обновлениями
+    железо обычно не меняется. Результат хранится в backups/hardware.json
+    вместе с отпечатком машины и пересчитывается при его несовпадении
+    или при refresh=True (флаг --refresh-hw).
+    """
+    from installer.hardware_detector import detect_hardware
+    from installer.utils import ensure_dir
+    
+    cache_file = Path("backups") / "hardware.json"
+    fingerprint = _hardware_fingerprint()
+    
+    if not refresh:
+        try:
+            cached = json.loads(cache_file.read_bytes())
+            if cached.get('fingerprint') == fingerprint:
+                return cached['hardware']
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+    
+    hardware = detect_hardware()
+    try:
+        ensure_dir("backups")
+        cache_file.write_text(
+            json.dumps({'fingerprint': fingerprint, 'hardware': hardware}),
+            encoding='utf-8'
+        )
+    except (OSError, TypeError, ValueError) as e:
+        console.print(f"[yellow]⚠ Не удалось сохранить кэш железа: {e}[/yellow]")
+    return hardware
+
+
+# Файлы, которые перегенерирует regenerate_configs
+_CONFIG_FILES = ('.env', 'docker-compose.yml', 'Caddyfile')
+
+
+def regenerate_configs(config, refresh_hardware=False, output_dir=None, env_config=None):
+    """
+    Перегенерирует конфигурационные файлы
+    
+    Если указан output_dir, файлы записываются туда, а не в корень проекта
+    (их затем переносит install_configs). env_config - уже прочитанные
+    переменные текущего .env: передаются в generate_env_file(existing=...),
+    чтобы добавленные вручную переменные сохранились без повторного чтения файла.
+    """
+    output_dir = Path(output_dir or '.')
     console.print("\n[cyan]⚙️ Перегенерация конфигурационных файлов...[/cyan]")
     
     try:
         from installer.config_generator import (
             generate_env_file, generate_docker_compose, generate_caddyfile
         )
-        from installer.hardware_detector import detect_hardware
-        
-        # Определяем железо (для выбора правильного шаблона)
-        console.print("Определение характеристик системы...")
-        hardware = detect_hardware()
         
-        # Генерируем .env
-        console.print("Генерация .env...")
-        generate_env_file(config)
-        console.print("[green]✓ .env обновлен[/green]")
-        
-        # Генерируем docker-compose.yml
-        console.print("Генерация docker-compose.yml...")
-        generate_docker_compose(config, hardware)
-        console.print("[green]✓ docker-compose.yml обновлен[/green]")
-        
-        # Генерируем Caddyfile
-        console.print("Генерация Caddyfile...")
-        generate_caddyfile(config)
-        console.print("[green]✓ Caddyfile обновлен[/green]")
+        # Файлы независимы друг от друга: .env и Caddyfile генерируются в потоках,
+        # пока определяется железо, нужное только для docker-compose.yml
+        console.print("Генерация .env, docker-compose.yml и Caddyfile...")
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            env_future = executor.submit(
+                generate_env_file, config, str(output_dir / '.env'), env_config
+            )
+            caddy_future = executor.submit(
+                generate_caddyfile, config, str(output_dir / 'Caddyfile')
+            )
+            
+            # Определяем железо (для выбора правильного шаблона)
+            hardware = cached_detect_hardware(refresh_hardware)
+            compose_future = executor.submit(
+                generate_docker_compose, config, hardware, str(output_dir / 'docker-compose.yml')
+            )
+            
+            # Результаты выводим в прежнем порядке; result() пробрасывает ошибку генератора
+            env_future.result()
+            console.print("[green]✓ .env обновлен[/green]")
+            compose_future.result()
+            console.print("[green]✓ docker-compose.yml обновлен[/green]")
+            caddy_future.result()
+            console.print("[green]✓ Caddyfile обновлен[/green]")
         
         return True
     except Exception as e:
@@ -421,13 +742,56 @@ def regenerate_configs(config):
         return False
 
 
-def restart_services():
-    """Перезапускает сервисы"""
-    console.print("\n[cyan]🔄 Перезапуск сервисов...[/cyan]")
+def install_configs(staging_dir):
+    """
+    Переносит сгенерированные файлы из staging_dir в корень проекта
+    
+    Сначала все файлы сбрасываются на диск, затем по очереди заменяют
+    старые через os.replace: при сбое посреди записи на месте останется
+    прежний файл целиком, а не обрезанный новый. Права и владелец
+    заменяемого файла переносятся на новый, чтобы .env с паролями
+    не стал доступен всем после обновления.
+    """
+    from installer.utils import copy_mode_and_owner
     
-    # Останавливаем
-    console.print("Остановка сервисов...")
-    if not docker_compose_down():
+    staged = [Path(staging_dir) / name for name in _CONFIG_FILES]
+    for path in staged:
+        target = Path(path.name)
+        if target.exists():
+            copy_mode_and_owner(target, path)
+        fd = os.open(path, os.O_RDWR)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    
+    for path in staged:
+        # Каталог создан в корне проекта, поэтому replace не копирует данные
+        os.replace(path, path.name)
+    
+    # Фиксируем сами переименования (на Windows каталог открыть нельзя)
+    try:
+        fd = os.open('.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def restart_services(stopped):
+    """
+    Запускает сервисы с новой конфигурацией
+    
+    Остановка (docker compose down) выполняется в main одновременно
+    с генерацией конфигов; stopped - ее результат.
+    """
+    from installer.docker_manager import docker_compose_up
+    
+    if not stopped:
         console.print("[yellow]⚠ Не удалось остановить сервисы[/yellow]")
         if not Confirm.ask("Продолжить?", default=False):
             return False
@@ -442,8 +806,122 @@ def restart_services():
         return False
 
 
-def main():
+# Отпечаток конфигурации, с которой сервисы были запущены в прошлый раз
+_CONFIG_HASH_FILE = Path("backups") / ".config.sha256"
+
+
+def config_fingerprint():
+    """
+    SHA-256 от текущего .env и коммита
+    
+    Все файлы генерируются из .env, поэтому достаточно его содержимого.
+    Коммит входит в отпечаток, потому что обновление может принести новые
+    шаблоны: тогда файлы нужно перегенерировать даже при тех же настройках.
+    """
+    try:
+        head = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            capture_output=True,
+            env=_GIT_READ_ENV,
+            text=True,
+            timeout=5
+        ).stdout.strip()
+    except Exception:
+        head = ''
+    digest = hashlib.sha256(head.encode('utf-8') + b'\0')
+    try:
+        digest.update(Path(".env").read_bytes())
+    except OSError:
+        pass
+    return digest.hexdigest()
+
+
+def config_unchanged(fingerprint):
+    """Проверяет, что сгенерированные файлы на месте и отпечаток не изменился"""
+    if not all(Path(name).exists() for name in _CONFIG_FILES):
+        return False
+    try:
+        return _CONFIG_HASH_FILE.read_text(encoding='utf-8').strip() == fingerprint
+    except OSError:
+        return False
+
+
+def save_config_fingerprint(fingerprint):
+    """Сохраняет отпечаток после успешного перезапуска (через os.replace)"""
+    try:
+        _CONFIG_HASH_FILE.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = _CONFIG_HASH_FILE.with_name(_CONFIG_HASH_FILE.name + '.tmp')
+        tmp_file.write_text(fingerprint + '\n', encoding='utf-8')
+        os.replace(tmp_file, _CONFIG_HASH_FILE)
+    except OSError as e:
+        console.print(f"[yellow]⚠ Не удалось сохранить отпечаток конфигурации: {e}[/yellow]")
+
+
+def regenerate_and_restart(config, refresh_hardware, backup_file, env_config=None):
+    """Перегенерирует конфигурационные файлы и перезапускает сервисы"""
+    from installer.docker_manager import docker_compose_down, docker_compose_up
+    
+    # Останавливаем сервисы и одновременно перегенерируем конфигурацию.
+    # docker compose down читает текущие .env и docker-compose.yml, поэтому
+    # новые файлы пишутся во временный каталог и заменяют старые после остановки
+    console.print("\n[cyan]🔄 Остановка сервисов...[/cyan]")
+    staging_dir = tempfile.mkdtemp(prefix='.update-', dir='.')
+    try:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            down = executor.submit(docker_compose_down)
+            generated = regenerate_configs(config, refresh_hardware, staging_dir, env_config)
+            stopped = down.result()
+        if generated:
+            install_configs(staging_dir)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    
+    if not generated:
+        console.print("\n[red]❌ Не удалось перегенерировать конфигурацию[/red]")
+        if stopped:
+            # Файлы не тронуты - возвращаем сервисы с прежней конфигурацией
+            console.print("Запуск сервисов с прежней конфигурацией...")
+            docker_compose_up()
+        if backup_file:
+            console.print(f"   Восстановите .env из резервной копии: {backup_file}")
+        return False
+    
+    # Запускаем сервисы с новой конфигурацией
+    if not restart_services(stopped):
+        console.print("\n[red]❌ Не удалось перезапустить сервисы[/red]")
+        if backup_file:
+            console.print(f"   Восстановите .env из резервной копии: {backup_file}")
+        return False
+    
+    return True
+
+
+# Ссылки на сервисы в итоговом сообщении: (название, имя в конфиге,
+# ключ локального порта, порт по умолчанию)
+_SERVICE_LINKS = (
+    ('N8N', 'n8n', 'n8n_port', 5678),
+    ('Langflow', 'langflow', 'langflow_port', 7860),
+    ('Supabase', 'supabase', 'supabase_kb_port', 3000),
+)
+
+
+def parse_args(argv=None):
+    """Разбирает аргументы командной строки"""
+    parser = argparse.ArgumentParser(
+        description="Обновление проекта с GitHub с сохранением настроек"
+    )
+    parser.add_argument('--refresh-hw', action='store_true',
+                        help="Заново определить железо, не используя backups/hardware.json")
+    parser.add_argument('--non-interactive', action='store_true',
+                        help="Не давать git запрашивать логин, пароль и парольную фразу SSH "
+                             "(включается само, если stdin не терминал)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
     """Главная функция"""
+    args = parse_args(argv)
+    
     try:
         show_welcome()
         
@@ -464,7 +942,8 @@ def main():
             sys.exit(1)
         
         # 3. Обновляем код с GitHub
-        if not update_from_github():
+        interactive = sys.stdin.isatty() and not args.non_interactive
+        if not update_from_github(interactive):
             console.print("\n[red]❌ Не удалось обновить код с GitHub[/red]")
             sys.exit(1)
         
@@ -475,35 +954,29 @@ def main():
             console.print("\n[red]❌ Не удалось конвертировать конфигурацию[/red]")
             sys.exit(1)
         
-        # 5. Перегенерируем конфигурационные файлы
-        if not regenerate_configs(config):
-            console.print("\n[red]❌ Не удалось перегенерировать конфигурацию[/red]")
-            if backup_file:
-                console.print(f"   Восстановите .env из резервной копии: {backup_file}")
-            sys.exit(1)
-        
-        # 6. Перезапускаем сервисы
-        if not restart_services():
-            console.print("\n[red]❌ Не удалось перезапустить сервисы[/red]")
-            if backup_file:
-                console.print(f"   Восстановите .env из резервной копии: {backup_file}")
-            sys.exit(1)
+        # 5-6. Перегенерируем конфигурацию и перезапускаем сервисы,
+        # если с прошлого обновления изменились код или настройки
+        if not args.refresh_hw and config_unchanged(config_fingerprint()):
+            console.print("\n[green]✓ Код и настройки не изменились - перегенерация и перезапуск не нужны[/green]")
+        else:
+            if not regenerate_and_restart(config, args.refresh_hw, backup_file, env_config):
+                sys.exit(1)
+            # Отпечаток нового .env: при следующем запуске он будет входным
+            save_config_fingerprint(config_fingerprint())
         
         console.print("\n[green]✓ Обновление завершено успешно![/green]")
         console.print("\n[cyan]Доступные сервисы:[/cyan]")
         
         # Показываем доступные сервисы
-        if config.get('routing_mode') == 'subdomain':
-            if config.get('n8n_domain'):
-                console.print(f"  N8N: https://{config['n8n_domain']}")
-            if config.get('langflow_domain'):
-                console.print(f"  Langflow: https://{config['langflow_domain']}")
-            if config.get('supabase_domain'):
-                console.print(f"  Supabase: https://{config['supabase_domain']}")
-        else:
-            console.print(f"  N8N: http://localhost:{config.get('n8n_port', 5678)}")
-            console.print(f"  Langflow: http://localhost:{config.get('langflow_port', 7860)}")
-            console.print(f"  Supabase: http://localhost:{config.get('supabase_kb_port', 3000)}")
+        get = config.get
+        subdomain = get('routing_mode') == 'subdomain'
+        for label, name, port_key, default_port in _SERVICE_LINKS:
+            if subdomain:
+                domain = get(f'{name}_domain')
+                if domain:
+                    console.print(f"  {label}: https://{domain}")
+            else:
+                console.print(f"  {label}: http://localhost:{get(port_key, default_port)}")
         
     except KeyboardInterrupt:
         console.print("\n[yellow]Обновление прервано пользователем[/yellow]")